@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from factors.portfolio import value_records
+from factors.scenarios import scenario_factors
+
+from conftest import quiet
+
+
+@pytest.mark.parametrize("table", ["aegon_table", "ag_table"])
+def bench_calculate_factors(benchmark, request, table):
+    tab = request.getfixturevalue(table)
+    benchmark.pedantic(quiet, args=(tab.calculate_factors, 3, 67), rounds=3)
+
+
+def bench_export(benchmark, aegon_table, tmpdir):
+    xlswb = str(tmpdir.join("factors.xlsx"))
+    benchmark.pedantic(quiet, args=(aegon_table.export, xlswb, 3, 67), rounds=3)
+
+
+@pytest.mark.parametrize("table", ["aegon_table", "ag_table"])
+def bench_cashflow_cube(benchmark, request, table):
+    tab = request.getfixturevalue(table)
+    benchmark(tab.cashflow_cube, 67, 3)
+
+
+def bench_pv_batch(benchmark, ag_table):
+    cube, labels = ag_table.cashflow_cube(67, 3)
+    curves = np.linspace(0.5, 4, 100)[:, None] * np.ones(cube.shape[-1])
+    benchmark(ag_table.pv_batch, cube, curves,
+              np.array(labels['insurance_id'])[:, None, None],
+              labels['age_insured'], 67)
+
+
+def bench_value_records(benchmark, aegon_table):
+    portfolio = aegon_table.testdata[['insurance_id', 'age', 'sex', 'pension_age', 'intrest']]
+    portfolio = portfolio.sample(100000, replace=True, random_state=0)
+    benchmark(value_records, aegon_table, portfolio)
+
+
+def bench_scenario_factors(benchmark, ag_table):
+    rng = np.random.default_rng(0)
+    curves = 2 + np.cumsum(rng.normal(0, .05, (1000, 60)), axis=1)
+    benchmark.pedantic(scenario_factors, args=(ag_table, curves, 67), rounds=3)
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from factors import LifeTable
+from factors.settings import LOWAGE, UPAGE, MALE, FEMALE
+
+from conftest import quiet
+
+
+@pytest.mark.parametrize("tablename, calc_year", [
+    ("AEG2011", 2017),
+    ("AG2022", 2022),
+    ])
+def bench_construction(benchmark, tablename, calc_year):
+    quiet(LifeTable, tablename, calc_year=calc_year)  # make sure the workbook is compiled
+    benchmark(quiet, LifeTable, tablename, calc_year=calc_year)
+
+
+def bench_npx_scalar(benchmark, ag_table):
+    benchmark(ag_table.npx, 40, MALE, 27)
+
+
+def bench_npx_array(benchmark, ag_table):
+    size = 100000
+    ages = np.random.RandomState(0).randint(LOWAGE, UPAGE, size)
+    sexes = np.where(np.arange(size) % 2, MALE, FEMALE)
+    benchmark(ag_table.npx, ages, sexes, 67 - ages)
+
+
+@pytest.mark.parametrize("method", [
+    "cf_retirement_pension",
+    "cf_defined_partner",
+    "cf_undefined_partner",
+    "cf_defined_one_year_risk",
+    "cf_undefined_one_year_risk",
+    "cf_ay_avg",
+    ])
+@pytest.mark.parametrize("table", ["aegon_table", "ag_table"])
+def bench_cf(benchmark, request, table, method):
+    tab = request.getfixturevalue(table)
+    benchmark(quiet, getattr(tab, method), 40, MALE, 67, intrest=3)
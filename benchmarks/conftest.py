@@ -0,0 +1,25 @@
+import contextlib
+import io
+
+import pytest
+
+from factors import LifeTable
+
+pytest.importorskip("pytest_benchmark")
+
+
+def quiet(func, *args, **kwargs):
+    """ Calls func without printing its progress messages.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        return func(*args, **kwargs)
+
+
+@pytest.fixture(scope="session")
+def aegon_table():
+    return quiet(LifeTable, "AEG2011")
+
+
+@pytest.fixture(scope="session")
+def ag_table():
+    return quiet(LifeTable, "AG2022", calc_year=2022)
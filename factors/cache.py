@@ -0,0 +1,467 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import threading
+import zipfile
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+import pandas as pd
+
+from factors.settings import DATADIR, CACHEDIR
+from factors.utils import x_to_series
+
+COMPILED_EXTENSION = '.npz'
+COMPILED_VERSION = 1  # bump when the layout of the compiled artifact changes
+
+# in-process copy of the compiled workbooks: {filepath: (sha256, sheets)}
+_workbooks = {}
+
+
+def file_hash(filepath):
+    """ Returns sha256 hex digest of given file.
+    """
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def get_compiled_filepath(xlswb, sha=None):
+    """ Returns path of the compiled artifact for given workbook.
+
+    The name holds the sha256 of the workbook, so an artifact is never used
+    for another workbook or another version of it.
+    """
+    sha = file_hash(xlswb) if sha is None else sha
+    name = os.path.splitext(os.path.basename(xlswb))[0]
+    return os.path.join(CACHEDIR, "{0}-{1}{2}".format(name, sha, COMPILED_EXTENSION))
+
+
+def write_sheets(filepath, sheets, sha):
+    """ Writes dict {sheet_name: DataFrame} to a .npz file that can be read without pickle.
+
+    Numeric columns are stored as arrays, other (object) columns as JSON, the
+    sheet and column names in a JSON header. Raises TypeError for values that
+    are not JSON serializable.
+
+    Parameters:
+    -----------
+    filepath: str
+    sheets: dict {sheet_name: DataFrame}, as read by pd.read_excel
+    sha: str. sha256 of the workbook, stored in the header.
+    """
+    header = {'version': COMPILED_VERSION, 'sha256': sha, 'sheets': []}
+    arrays = {}
+    for i, (sheet_name, df) in enumerate(sheets.items()):
+        header['sheets'].append([sheet_name, list(df.columns)])
+        for j, column in enumerate(df.columns):
+            values = df.iloc[:, j]
+            key = 's{0}c{1}'.format(i, j)
+            if values.dtype.kind in 'biufcmM':
+                arrays[key] = values.to_numpy()
+            else:
+                arrays[key] = np.array(json.dumps(values.tolist()))
+    arrays['header'] = np.array(json.dumps(header))
+    temp_filepath = "{0}.{1}.{2}.tmp".format(filepath, os.getpid(), threading.get_ident())
+    with open(temp_filepath, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(temp_filepath, filepath)
+
+
+def read_sheets(filepath):
+    """ Returns (sha256, dict {sheet_name: DataFrame}) of file of write_sheets.
+
+    Raises ValueError for files of another COMPILED_VERSION.
+    """
+    with np.load(filepath, allow_pickle=False) as data:
+        header = json.loads(data['header'].item())
+        if header.get('version') != COMPILED_VERSION:
+            raise ValueError("{0} has version {1}, expected {2}".format(
+                filepath, header.get('version'), COMPILED_VERSION))
+        sheets = OrderedDict()
+        for i, (sheet_name, columns) in enumerate(header['sheets']):
+            values = []
+            for j in range(len(columns)):
+                array = data['s{0}c{1}'.format(i, j)]
+                if array.ndim == 0:
+                    array = pd.Series(json.loads(array.item()), dtype=object)
+                values.append(array)
+            df = pd.DataFrame(dict(enumerate(values)))
+            df.columns = pd.Index(columns)
+            sheets[sheet_name] = df
+    return header['sha256'], sheets
+
+
+def compile_workbook(xlswb, sha=None):
+    """ Reads all sheets of given workbook and stores them as binary artifact.
+
+    Parameters:
+    -----------
+    xlswb: str
+    sha: str. sha256 of xlswb, computed if not given.
+    """
+    sha = file_hash(xlswb) if sha is None else sha
+    sheets = pd.read_excel(xlswb, sheet_name=None)
+    compiled_filepath = get_compiled_filepath(xlswb, sha)
+    try:
+        os.makedirs(CACHEDIR, exist_ok=True)
+        write_sheets(compiled_filepath, sheets, sha)
+    except (OSError, TypeError) as e:
+        print("Could not write compiled table {0}: {1}".format(compiled_filepath, e))
+    return sheets
+
+
+def load_workbook(xlswb):
+    """ Returns dict {sheet_name: DataFrame} for given workbook.
+
+    The compiled artifact is used if there is one for the current version
+    of the workbook, otherwise the workbook is (re)compiled.
+    """
+    sha = file_hash(xlswb)
+    if xlswb in _workbooks and _workbooks[xlswb][0] == sha:
+        return _workbooks[xlswb][1]
+    sheets = None
+    compiled_filepath = get_compiled_filepath(xlswb, sha)
+    if os.path.isfile(compiled_filepath):
+        try:
+            compiled_sha, sheets = read_sheets(compiled_filepath)
+            if compiled_sha != sha:
+                sheets = None
+        except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+            # unreadable or written by another COMPILED_VERSION
+            sheets = None
+    if sheets is None:
+        sheets = compile_workbook(xlswb, sha)
+    _workbooks[xlswb] = (sha, sheets)
+    return sheets
+
+
+def read_sheet(xlswb, sheet_name):
+    """ Returns (a copy of) given sheet of given workbook.
+    """
+    return load_workbook(xlswb)[sheet_name].copy()
+
+
+def get_sheet_names(xlswb):
+    """ Returns sheet names of given workbook.
+    """
+    return list(load_workbook(xlswb).keys())
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class LRUCache(object):
+    """ Bounded, thread-safe mapping that evicts the least recently used item.
+
+    Parameters:
+    -----------
+    maxsize: int, maximum number of items
+    maxbytes: int, maximum total size of the items. Optional.
+    sizeof: function returning the size (bytes) of an item. Default nbytes.
+    """
+
+    def __init__(self, maxsize=128, maxbytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof or nbytes
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._items = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        size = self.sizeof(value) if self.maxbytes is not None else 0
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            self._items[key] = value
+            self._sizes[key] = size
+            self.nbytes += size
+            while len(self._items) > self.maxsize or (
+                    self.maxbytes is not None and self.nbytes > self.maxbytes and
+                    len(self._items) > 1):
+                self._remove(next(iter(self._items)))
+
+    def _remove(self, key):
+        del self._items[key]
+        self.nbytes -= self._sizes.pop(key)
+
+    def invalidate(self, match):
+        """ Removes items of which match(key) is True, returns number of removed items.
+        """
+        with self._lock:
+            keys = [key for key in self._items if match(key)]
+            for key in keys:
+                self._remove(key)
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._sizes.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """ Returns CacheInfo(hits, misses, maxsize, currsize).
+        """
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._items))
+
+
+def nbytes(value):
+    """ Returns number of bytes of the arrays in value (array, dict, list or tuple).
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(nbytes(x) for x in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes(x) for x in value)
+    return 0
+
+
+def rate_key(intrest):
+    """ Returns hashable key for given intrest (int, float, list, Series or array).
+    """
+    if isinstance(intrest, (int, float, np.number)):
+        return float(intrest)
+    rates = np.ascontiguousarray(intrest, dtype=float)
+    return (rates.shape, hashlib.sha1(rates.tobytes()).hexdigest())
+
+
+# discount factor vectors shared by LifeTable.pv, ay_avg and create_lookup_table
+DISCOUNT_FACTORS = LRUCache(maxsize=256)
+
+
+def discount_factors(intrest, nyears, offset=0.):
+    """ Returns (read-only) array of discount factors for years 0..nyears-1.
+
+    Parameters:
+    -----------
+    intrest: int, float, list or Series (in pct)
+    nyears: int
+    offset: float, timing within the year. 0 for payments at the start
+    of the year, 0.5 for payments in the middle of the year.
+    """
+    key = (rate_key(intrest), nyears, offset)
+    out = DISCOUNT_FACTORS.get(key)
+    if out is None:
+        rates = x_to_series(intrest, nyears).to_numpy(dtype=float)
+        out = (1. / (1 + rates / 100.)) ** (np.arange(nyears) + offset)
+        out.flags.writeable = False
+        DISCOUNT_FACTORS.put(key, out)
+    return out
+
+
+# cash flows of LifeTable.cashflow_parts: {(tablename, calc_year, genders, pension_age,
+# insurance_id): parts}, bounded by CASHFLOW_CACHE_BYTES
+CASHFLOW_CACHE_BYTES = 256 * 1024 * 1024
+CASHFLOWS = LRUCache(maxsize=4096, maxbytes=CASHFLOW_CACHE_BYTES)
+
+
+ARRAYS_MAGIC = b'FACTARR1'
+ARRAYS_VERSION = 1  # bump when the layout of the header or arrays changes
+ARRAYS_ALIGNMENT = 64
+
+
+def write_arrays(filepath, arrays, meta=None):
+    """ Writes float64 arrays to one binary file that can be memory mapped by read_arrays.
+
+    The file starts with ARRAYS_MAGIC, the length of a JSON header (8 bytes,
+    little endian) and the header itself, holding meta and the shape and
+    offset of each array and ARRAYS_VERSION. The arrays follow, aligned on
+    ARRAYS_ALIGNMENT bytes.
+
+    Parameters:
+    -----------
+    filepath: str
+    arrays: dict {name: array}
+    meta: dict, stored in the header. Optional.
+    """
+    arrays = OrderedDict((name, np.ascontiguousarray(array, dtype='<f8'))
+                         for name, array in arrays.items())
+    entries = []
+    offset = 0
+    for name, array in arrays.items():
+        entries.append([name, list(array.shape), offset])
+        offset += -(-array.nbytes // ARRAYS_ALIGNMENT) * ARRAYS_ALIGNMENT
+    header = json.dumps({'version': ARRAYS_VERSION, 'meta': meta or {},
+                         'arrays': entries}).encode('utf-8')
+    start = -(-(len(ARRAYS_MAGIC) + 8 + len(header)) // ARRAYS_ALIGNMENT) * ARRAYS_ALIGNMENT
+    temp_filepath = "{0}.{1}.{2}.tmp".format(filepath, os.getpid(), threading.get_ident())
+    with open(temp_filepath, 'wb') as f:
+        f.write(ARRAYS_MAGIC + len(header).to_bytes(8, 'little') + header)
+        for (_, _, array_offset), array in zip(entries, arrays.values()):
+            f.seek(start + array_offset)
+            f.write(array.tobytes())
+        f.truncate(start + offset)
+    os.replace(temp_filepath, filepath)
+
+
+def read_arrays(filepath):
+    """ Returns (meta, dict {name: read-only memory mapped array}) of file of write_arrays.
+
+    Raises ValueError for files of another ARRAYS_VERSION.
+    """
+    with open(filepath, 'rb') as f:
+        if f.read(len(ARRAYS_MAGIC)) != ARRAYS_MAGIC:
+            raise ValueError("{} is not an arrays file".format(filepath))
+        length = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(length).decode('utf-8'))
+    if header.get('version') != ARRAYS_VERSION:
+        raise ValueError("{0} has version {1}, expected {2}".format(
+            filepath, header.get('version'), ARRAYS_VERSION))
+    start = -(-(len(ARRAYS_MAGIC) + 8 + length) // ARRAYS_ALIGNMENT) * ARRAYS_ALIGNMENT
+    arrays = OrderedDict((name, np.memmap(filepath, dtype='<f8', mode='r',
+                                          offset=start + offset, shape=tuple(shape)))
+                         for name, shape, offset in header['arrays'])
+    return header['meta'], arrays
+
+
+def content_key(*items):
+    """ Returns sha256 hex digest of given items (str, numbers, tuples, arrays).
+    """
+    sha = hashlib.sha256()
+    for item in items:
+        if isinstance(item, np.ndarray):
+            sha.update(np.ascontiguousarray(item).tobytes())
+        else:
+            sha.update(repr(item).encode('utf-8'))
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+
+class DiskCache(object):
+    """ Persistent cache of arrays, shared by processes and runs.
+
+    Every entry is a directory named after its (content addressed) key with
+    one .npy file per array and a manifest listing them. Entries are read as
+    memory mapped arrays. When the total size exceeds maxbytes the least
+    recently used entries are removed.
+
+    Parameters:
+    -----------
+    directory: str. Default <CACHEDIR>/arrays.
+    maxbytes: int. Default DISK_CACHE_BYTES.
+    """
+    VERSION = 2  # bump when the layout of cached results changes
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, directory=None, maxbytes=None):
+        self.directory = directory or os.path.join(CACHEDIR, 'arrays')
+        self.maxbytes = DISK_CACHE_BYTES if maxbytes is None else maxbytes
+
+    def key(self, *items):
+        return content_key(self.VERSION, *items)
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """ Returns dict {name: read-only memory mapped array} or None if key is not cached.
+
+        An entry only counts if all arrays of its manifest can be read, so an entry
+        which is being removed by another process is a miss.
+        """
+        path = self.get_path(key)
+        try:
+            with open(os.path.join(path, self.MANIFEST)) as f:
+                names = json.load(f)
+            out = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                   for name in names}
+            os.utime(path)  # mark as recently used
+        except (OSError, ValueError):
+            return None
+        return out
+
+    def put(self, key, arrays):
+        """ Stores dict {name: array} under key.
+        """
+        path = self.get_path(key)
+        temp_path = "{0}.{1}.{2}.tmp".format(path, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(temp_path)
+            for name, array in arrays.items():
+                np.save(os.path.join(temp_path, name + '.npy'), np.asarray(array))
+            with open(os.path.join(temp_path, self.MANIFEST), 'w') as f:
+                json.dump(list(arrays), f)
+            try:
+                os.rename(temp_path, path)
+            except OSError:
+                # stored by another process in the meantime
+                shutil.rmtree(temp_path, ignore_errors=True)
+            self.evict()
+        except OSError as e:
+            shutil.rmtree(temp_path, ignore_errors=True)
+            print("Could not write cache entry {0}: {1}".format(path, e))
+
+    def entries(self):
+        """ Returns list of (last used, size, path) of all entries, least recently used first.
+        """
+        out = []
+        for name in os.listdir(self.directory) if os.path.isdir(self.directory) else []:
+            path = os.path.join(self.directory, name)
+            if name.endswith('.tmp') or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, x)) for x in os.listdir(path))
+                out.append((os.path.getmtime(path), size, path))
+            except OSError:
+                continue
+        return sorted(out)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """ Removes least recently used entries till the cache fits in maxbytes.
+        """
+        entries = self.entries()
+        nbytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if nbytes <= self.maxbytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            nbytes -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            shutil.rmtree(path, ignore_errors=True)
+
+
+DISK_CACHE_BYTES = 1024 * 1024 * 1024
+
+
+def compile_tables(datadir=DATADIR):
+    """ Compiles all workbooks in datadir.
+    """
+    for xlswb in sorted(glob.glob(os.path.join(datadir, '*.xlsx'))):
+        print("Compiling {}".format(xlswb))
+        load_workbook(xlswb)
+
+
+if __name__ == "__main__":
+    compile_tables()
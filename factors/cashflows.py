@@ -0,0 +1,211 @@
+""" Compact representation of cash flows.
+
+Cash flows are zero before the deferral period and after the last age of
+the table. A CashFlow only stores the payments from the first to the last
+non-zero payment and the year of the first one, instead of an array or
+Series padded with zeros to the full number of years.
+
+Many cash flows are kept as an object array of CashFlows (see from_array).
+pack concatenates their payments, so present values and long tables are
+calculated without materializing the zero padding.
+"""
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from factors.utils import half_year, label_column
+
+
+class CashFlow(object):
+    """ Cash flows of nyears years, of which only the years start till
+    start + len(values) can be non-zero.
+
+    Parameters:
+    -----------
+    values: array-like, payments as of year start
+    start: int, year of the first value. Default 0.
+    nyears: int, number of years. Default start + len(values).
+    """
+    __slots__ = ('start', 'values', 'nyears')
+
+    def __init__(self, values, start=0, nyears=None):
+        self.values = np.ascontiguousarray(values, dtype=np.float64)
+        self.start = int(start)
+        self.nyears = self.stop if nyears is None else int(nyears)
+        if self.start < 0 or self.stop > self.nyears:
+            raise ValueError("payments should be within year 0 and nyears")
+
+    @classmethod
+    def from_array(cls, array, tol=0.):
+        """ Returns CashFlow of array of payments, without the years at the start
+        and the end with payments of at most tol (in absolute value).
+        """
+        array = np.asarray(array, dtype=np.float64)
+        payable = np.flatnonzero(~(np.abs(array) <= tol))  # keeps NaN
+        if not len(payable):
+            return cls(np.empty(0), 0, len(array))
+        return cls(array[payable[0]:payable[-1] + 1].copy(), payable[0], len(array))
+
+    @property
+    def stop(self):
+        return self.start + len(self.values)
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes
+
+    def __len__(self):
+        return self.nyears
+
+    def __repr__(self):
+        return "CashFlow(start={0}, nyears={1}, values={2})".format(
+            self.start, self.nyears, self.values)
+
+    def __eq__(self, other):
+        return (isinstance(other, CashFlow) and self.nyears == other.nyears and
+                np.array_equal(self.to_array(), other.to_array()))
+
+    def to_array(self, nyears=None):
+        """ Returns payments as array padded with zeros to nyears (default self.nyears).
+        """
+        out = np.zeros(self.nyears if nyears is None else nyears)
+        values = self.values[:max(len(out) - self.start, 0)]
+        out[self.start:self.start + len(values)] = values
+        return out
+
+    def to_series(self):
+        """ Returns payments as Series indexed by year, see LifeTable.cf.
+        """
+        return pd.Series(self.to_array(), index=pd.RangeIndex(self.nyears, name='year'))
+
+    def dot(self, factors):
+        """ Returns sum of payments times factors (per year), for example a present value.
+        """
+        return np.dot(self.values, np.asarray(factors, dtype=float)[self.start:self.stop])
+
+
+def is_cashflows(x):
+    """ Returns True if x is a CashFlow, or a list or object array of CashFlows.
+    """
+    if isinstance(x, CashFlow):
+        return True
+    if isinstance(x, np.ndarray):
+        return x.dtype == object and x.size > 0 and isinstance(x.flat[0], CashFlow)
+    if isinstance(x, (list, tuple)):
+        return len(x) > 0 and is_cashflows(x[0])
+    return False
+
+
+def as_payments(payments, sparse):
+    """ Returns payments (Series indexed by year or CashFlow) as CashFlow if sparse,
+    else as Series indexed by year.
+    """
+    if sparse:
+        return payments if isinstance(payments, CashFlow) else CashFlow.from_array(payments)
+    return payments.to_series() if isinstance(payments, CashFlow) else payments
+
+
+def as_cashflow_array(cashflows):
+    """ Returns object array of given CashFlow, (nested) list or array of CashFlows.
+    """
+    if isinstance(cashflows, np.ndarray):
+        return cashflows
+    if isinstance(cashflows, CashFlow):
+        out = np.empty((), dtype=object)
+        out[()] = cashflows
+        return out
+    items = [as_cashflow_array(x) for x in cashflows]
+    out = np.empty((len(items),) + (items[0].shape if items else ()), dtype=object)
+    for i, item in enumerate(items):
+        out[i] = item
+    return out
+
+
+def from_array(array, tol=0.):
+    """ Returns object array of CashFlows of the cash flows in the last axis of array,
+    for example the cube of LifeTable.cashflow_cube.
+
+    Parameters:
+    -----------
+    array: array (..., nyears)
+    tol: float, payments at the start and end of at most tol are dropped. Default 0.
+    """
+    array = np.asarray(array, dtype=np.float64)
+    out = np.empty(array.shape[:-1], dtype=object)
+    for index in np.ndindex(out.shape):
+        out[index] = CashFlow.from_array(array[index], tol)
+    return out
+
+
+def pack(cashflows):
+    """ Returns the payments of all cash flows concatenated.
+
+    Returns (values, index, years, offsets): the payments, the flat index of the
+    cash flow and the year of each payment, and the position in values of the
+    first payment of each cash flow.
+
+    Parameters:
+    -----------
+    cashflows: object array of CashFlows
+    """
+    flat = list(cashflows.flat)
+    lengths = np.array([len(x.values) for x in flat], dtype=np.int64)
+    starts = np.array([x.start for x in flat], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+    values = (np.concatenate([x.values for x in flat]) if lengths.sum() else
+              np.empty(0))
+    index = np.repeat(np.arange(len(flat)), lengths)
+    years = np.arange(len(values)) - offsets[index] + starts[index]
+    return values, index, years, offsets
+
+
+def present_values(cashflows, discount, insurance_id, age=None, pension_age=None):
+    """ Returns present values of cash flows for a number of yield curves.
+
+    Parameters:
+    -----------
+    cashflows: object array of CashFlows
+    discount: array (n_scenarios, 2 * nyears), discount factors at the start of
+    each year followed by the discount factors in the middle of each year
+    insurance_id: str or array of str, broadcastable to cashflows.shape
+    age: int or array. Required for undefined partner pension.
+    pension_age: int or array. Required for undefined partner pension.
+
+    Returns array (n_scenarios,) + cashflows.shape.
+    """
+    values, index, years, offsets = pack(cashflows)
+    nyears = discount.shape[1] // 2
+
+    def per_payment(x):
+        return None if x is None else np.broadcast_to(x, cashflows.shape).ravel()[index]
+
+    mid_year = half_year(per_payment(insurance_id), per_payment(age),
+                         per_payment(pension_age), years)
+    weighted = discount[:, years + nyears * mid_year] * values
+    out = np.zeros((len(discount), cashflows.size))
+    paid = np.bincount(index, minlength=cashflows.size) > 0
+    if paid.any():
+        out[:, paid] = np.add.reduceat(weighted, offsets[paid], axis=1)
+    return out.reshape((len(discount),) + cashflows.shape)
+
+
+def to_table(cashflows, labels, name):
+    """ Returns DataFrame in long (columnar) format like utils.array_to_table,
+    with one row per stored payment of each cash flow instead of one per year.
+
+    Parameters:
+    -----------
+    cashflows: object array of CashFlows
+    labels: OrderedDict {column name: labels of axis}, for the axes of cashflows
+    followed by the name of the year column
+    name: str, name of the value column
+    """
+    values, index, years, _ = pack(cashflows)
+    columns = list(labels)
+    out = OrderedDict()
+    for column, codes in zip(columns, np.unravel_index(index, cashflows.shape)):
+        out[column] = label_column(labels[column], codes)
+    out[columns[-1]] = years.astype(np.int16)
+    out[name] = values
+    return pd.DataFrame(out)
@@ -0,0 +1,337 @@
+""" Array versions of the LifeTable cash flow calculations.
+
+The functions in this module compute cash flows for a vector of ages at once.
+They take a table object exposing `lx_array`, `hx_array`, `adjust` and `params`
+(see LifeTable) and a gender index (see utils.gender_index) instead of 'M'/'F'.
+All cash flows are returned as arrays of shape (len(age), nyears).
+"""
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from factors.settings import GENDERS
+
+
+def check_ages(*ages):
+    """ Raises ValueError if any of the ages is negative, for example the age of a
+    beneficiary after the partner adjustments. NumPy would wrap negative indices
+    around to the end of the lx table.
+    """
+    for age in ages:
+        if np.any(np.asarray(age) < 0):
+            raise ValueError("ages should be >= 0, got {}".format(np.min(age)))
+
+
+def lx_at(lx, gender, current_age, age):
+    """ Returns lx[age] for persons with given current age.
+
+    Parameters:
+    -----------
+    lx: lx_array, either [gender, age] (flat) or [gender, current_age, age]
+    gender: int or array
+    current_age: int or array
+    age: int or array
+    """
+    check_ages(current_age, age)
+    age = np.asarray(age).astype(int)
+    if lx.ndim == 2:
+        return lx[gender, age]
+    return lx[gender, np.asarray(current_age).astype(int), age]
+
+
+def npx(lx, gender, age, nyears):
+    """ Returns probability person with given age is still alive after n years.
+    """
+    maxage = lx.shape[-1] - 1
+    age = np.asarray(age)
+    future_age = np.minimum(age + np.asarray(nyears), maxage)
+    current_age = np.minimum(age, maxage)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (lx_at(lx, gender, current_age, future_age) /
+                lx_at(lx, gender, current_age, current_age))
+
+
+def lx_rows(lx, gender, current_age, nyears, age=None):
+    """ Returns lx[age + t], t = 0..nyears - 1, for persons with given current age.
+
+    Ages beyond the table get lx of the last age (as npx). The rows are copied
+    from a sliding window view on lx instead of gathered element by element.
+    Returns (writable) array of shape broadcast shape + (nyears,).
+
+    Parameters:
+    -----------
+    lx: lx_array
+    gender: int or array
+    current_age: int or array, selects the lx table (generation tables)
+    nyears: int
+    age: int or array. Default current_age.
+    """
+    check_ages(current_age, current_age if age is None else age)
+    maxage = lx.shape[-1] - 1
+    current_age = np.minimum(np.asarray(current_age).astype(int), maxage)
+    age = current_age if age is None else np.minimum(np.asarray(age).astype(int), maxage)
+    padded = np.concatenate([lx, np.repeat(lx[..., -1:], nyears - 1, axis=-1)], axis=-1)
+    windows = sliding_window_view(padded, nyears, axis=-1)
+    rows = windows[gender, age] if lx.ndim == 2 else windows[gender, current_age, age]
+    return np.require(rows, requirements='W')  # scalar indices give a read-only view
+
+
+def annuity(lx, gender, current_age, age, nyears, defer=0):
+    """ Returns expected payments (deferred) lifetime annuity, see LifeTable.cf_annuity.
+
+    Parameters:
+    -----------
+    lx: lx_array
+    gender: int or array
+    current_age: int or array, selects the lx table (generation tables)
+    age: int or array
+    nyears: int, number of columns of the result
+    defer: int or array
+    """
+    maxage = lx.shape[-1] - 1
+    age = np.asarray(age).astype(int)
+    year = np.arange(nyears)
+    payable = (age[..., None] + year <= maxage) & (year >= np.asarray(defer)[..., None])
+    out = lx_rows(lx, gender, current_age, nyears, age)  # a copy, updated in place
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.divide(out, out[..., :1].copy(), out=out)
+    np.copyto(out, 0., where=~payable | np.isnan(out))
+    return out
+
+
+def prae_to_continuous(cfs):
+    """ Converts preanumerando to continuous cashflows (see utils.prae_to_continuous):
+    the first positive cash flow is halved.
+
+    Parameters:
+    -----------
+    cfs: array, cash flows in last dimension
+    """
+    first = (cfs > 0).argmax(axis=-1)[..., None]
+    out = cfs.copy()
+    np.put_along_axis(out, first, 0.5 * np.take_along_axis(cfs, first, axis=-1), axis=-1)
+    return out
+
+
+def adjustment(tab, gender, insurance_type, item):
+    """ Returns adjustment (tbl_adjustments) for given gender(s).
+    """
+    values = np.array([tab.adjust[sex][insurance_type][item] for sex in GENDERS])
+    return values[gender]
+
+
+def factor(tab, gender, insurance_type):
+    """ Returns product of fnett, fcorr and fOTS for given gender(s).
+    """
+    return np.prod([adjustment(tab, gender, insurance_type, item)
+                    for item in ['fnett', 'fcorr', 'fOTS']], axis=0)
+
+
+def beneficiary_age(tab, age, gender, insurance_type='partner'):
+    """ Returns (gender, current age) of the beneficiary of insured with given age.
+    """
+    gender_beneficiary = 1 - gender
+    sign = np.where(gender == 0, 1, -1)
+    delta = int(tab.params['delta'])
+    gamma3 = adjustment(tab, gender_beneficiary, insurance_type, 'CX3')
+    return gender_beneficiary, age - sign * delta + gamma3
+
+
+def cf_ay_avg(tab, age, gender, nyears, insurance_type='partner'):
+    """ Returns cash flows non-defered annuity for beneficiary, see LifeTable.cf_ay_avg.
+    """
+    gender_beneficiary, current_age = beneficiary_age(tab, np.asarray(age), gender,
+                                                      insurance_type)
+    cf = annuity(tab.lx_array, gender_beneficiary, current_age, current_age, nyears)
+    cf += annuity(tab.lx_array, gender_beneficiary, current_age, current_age + 1, nyears)
+    cf *= 0.5
+    return prae_to_continuous(cf)
+
+
+def cf_retirement_pension(tab, age, gender, pension_age, nyears, postnumerando=False):
+    """ Returns expected payments retirement pension, see LifeTable.cf_retirement_pension.
+
+    age, gender and pension_age are broadcast against each other.
+    """
+    age, gender, pension_age = np.broadcast_arrays(age, gender, pension_age)
+    alpha1 = adjustment(tab, gender, 'retire', 'CX1')
+    alpha2 = adjustment(tab, gender, 'retire', 'CX2')
+    current_age = age + alpha2
+    cf = annuity(tab.lx_array, gender, current_age, current_age, nyears,
+                 defer=pension_age - age + postnumerando)
+    cf = prae_to_continuous(cf)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = (npx(tab.lx_array, gender, age + alpha1, pension_age - age) /
+                 npx(tab.lx_array, gender, age + alpha2, pension_age - age))
+    return cf * (ratio * factor(tab, gender, 'retire'))[..., None]
+
+
+def cf_defined_partner(tab, age, gender, pension_age, nyears):
+    """ Returns expected payments partner pension (defined partner),
+    see LifeTable.cf_defined_partner.
+
+    age, gender and pension_age are broadcast against each other, so one call
+    gives the cash flows of any mix of ages, sexes and pension ages:
+
+        factor * (ay - ax1 * ay + [t >= pension_age - age] * ay * (ax1 - ax2 * p))
+
+    with ay the annuity of the beneficiary, ax1 and ax2 the annuities of the
+    insured at current ages age + CX1 and age + CX2, and p the ratio of the
+    survival probabilities till pension age of both.
+    """
+    lx = tab.lx_array
+    age, gender, pension_age = np.broadcast_arrays(age, gender, pension_age)
+    alpha1 = adjustment(tab, gender, 'partner', 'CX1')
+    alpha2 = adjustment(tab, gender, 'partner', 'CX2')
+    gender_beneficiary, current_age_beneficiary = beneficiary_age(tab, age, gender)
+    current_age_alpha1 = age + alpha1
+    current_age_alpha2 = age + alpha2
+    deferred = np.arange(nyears) >= (pension_age - age)[..., None]
+
+    ay = annuity(lx, gender_beneficiary, current_age_beneficiary,
+                 current_age_beneficiary, nyears)
+    ax1 = annuity(lx, gender, current_age_alpha1, current_age_alpha1, nyears)
+    ax2 = annuity(lx, gender, current_age_alpha2, current_age_alpha2, nyears)
+    temp1 = (lx_at(lx, gender, current_age_alpha1, pension_age + alpha1) /
+             lx_at(lx, gender, current_age_alpha1, current_age_alpha1))
+    temp2 = (lx_at(lx, gender, current_age_alpha2, current_age_alpha2) /
+             lx_at(lx, gender, current_age_alpha2, pension_age + alpha2))
+    f1_minus_f2 = np.where(deferred, ay * (ax1 - ax2 * (temp1 * temp2)[..., None]), 0.)
+    return factor(tab, gender, 'partner')[..., None] * (ay - ax1 * ay + f1_minus_f2)
+
+
+def unique_index(*arrays):
+    """ Returns (unique, inverse) of the combinations of values of the broadcast arrays.
+
+    unique is an array (n_unique, len(arrays)), inverse has the broadcast shape
+    and gives the row of unique of each element, so values depending on the
+    combination only are calculated once per combination.
+    """
+    arrays = np.broadcast_arrays(*arrays)
+    values, codes = zip(*[np.unique(x.ravel(), return_inverse=True) for x in arrays])
+    shape = [len(x) for x in values]
+    key, inverse = np.unique(np.ravel_multi_index(codes, shape), return_inverse=True)
+    unique = np.stack([x[i] for x, i in zip(values, np.unravel_index(key, shape))], axis=1)
+    return unique, inverse.reshape(arrays[0].shape)
+
+
+def cf_after_pension_age(tab, age, gender, pension_age, nyears, hx_at_pension_age, out=None):
+    """ Returns the cash flows of the undefined partner pension after pension age.
+
+    From pension age on the undefined partner pension is a defined partner
+    pension bought at pension age. Its cash flows are calculated once per
+    combination of gender and pension_age and shifted to the year the
+    insured reaches pension age.
+
+    Parameters:
+    -----------
+    out: array (broadcast shape + (nyears,)) the cash flows are written to. Optional.
+    """
+    age, gender, pension_age, hx_at_pension_age = np.broadcast_arrays(
+        age, gender, pension_age, hx_at_pension_age)
+    alpha1 = adjustment(tab, gender, 'partner', 'CX1')
+    prob = npx(tab.lx_array, gender, age + alpha1, pension_age - age)
+    unique, inverse = unique_index(gender, pension_age)
+    cf_at_pension_age = cf_defined_partner(tab, unique[:, 1], unique[:, 0], unique[:, 1],
+                                           nyears)
+    # row of windows[i, maxshift - shift] is cf_at_pension_age[i] shifted by shift years
+    shift = np.minimum(np.maximum(pension_age - age, 0), nyears)
+    maxshift = int(np.max(shift, initial=0))
+    padded = np.zeros((len(unique), maxshift + nyears))
+    padded[:, maxshift:] = cf_at_pension_age
+    windows = sliding_window_view(padded, nyears, axis=-1)
+    if out is None:
+        out = np.empty(age.shape + (nyears,))
+    np.multiply(windows[inverse, maxshift - shift], (hx_at_pension_age * prob)[..., None],
+                out=out)
+    return out
+
+
+def till_pension_age_parts(tab, age, gender, pension_age, nyears):
+    """ Returns (till_pension_age, nq, age_in_year) of the undefined partner pension for
+    the years till pension age, arrays of shape broadcast shape + (n,) with n the
+    largest number of years till pension age (at most nyears).
+
+    nq is the probability the insured dies in year t (zero from pension age on).
+    """
+    age, gender, pension_age = np.broadcast_arrays(age, gender, pension_age)
+    nyears_till_pension_age = np.maximum(pension_age - age, 0)
+    n = min(int(np.max(nyears_till_pension_age, initial=0)), nyears)
+    year = np.arange(n)
+    till_pension_age = year < nyears_till_pension_age[..., None]
+    age_in_year = np.minimum(age[..., None] + year, tab.lx_array.shape[-1] - 1)
+    alpha1 = adjustment(tab, gender, 'partner', 'CX1')
+    lx = lx_rows(tab.lx_array, gender, age + alpha1, n + 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        nq = (lx[..., :-1] - lx[..., 1:]) / lx[..., :1]
+    nq = np.where(till_pension_age, nq, 0.)
+    return till_pension_age, nq, age_in_year
+
+
+def undefined_partner_parts(tab, age, gender, pension_age, nyears, hx_at_pension_age):
+    """ Returns the parts of the undefined partner cash flows that do not depend on intrest.
+
+    The cash flows are lookup[gender, age_in_year] * nq (where till_pension_age)
+    plus cf_after_pension_age, with lookup the only part depending on intrest.
+    age, gender, pension_age and hx_at_pension_age are broadcast against each other.
+
+    Returns (till_pension_age, nq, age_in_year, cf_after_pension_age), all
+    arrays of shape broadcast shape + (nyears,).
+    """
+    age = np.asarray(age)
+    till_pension_age, nq, _ = till_pension_age_parts(tab, age, gender, pension_age, nyears)
+    pad = [(0, 0)] * (nq.ndim - 1) + [(0, nyears - nq.shape[-1])]
+    till_pension_age, nq = np.pad(till_pension_age, pad), np.pad(nq, pad)
+    age_in_year = np.minimum(age[..., None] + np.arange(nyears), tab.lx_array.shape[-1] - 1)
+    age_in_year = np.broadcast_to(age_in_year, nq.shape)
+    cf_after = cf_after_pension_age(tab, age, gender, pension_age, nyears, hx_at_pension_age)
+    return till_pension_age, nq, age_in_year, cf_after
+
+
+def cf_undefined_partner(tab, age, gender, pension_age, nyears,
+                         lookup, hx_at_pension_age, out=None):
+    """ Returns expected payments partner pension (undefined partner),
+    see LifeTable.cf_undefined_partner.
+
+    The cash flows after pension age (cf_after_pension_age) are written to out,
+    after which the years till pension age are filled from the lookup table.
+
+    Parameters:
+    -----------
+    age, gender, pension_age: int or array, broadcast against each other
+    lookup: array [gender, age] with column 'cf' of LifeTable.create_lookup_table
+    hx_at_pension_age: float or array
+    out: array (broadcast shape + (nyears,)) the cash flows are written to. Optional.
+    """
+    out = cf_after_pension_age(tab, age, gender, pension_age, nyears, hx_at_pension_age,
+                               out)
+    till_pension_age, nq, age_in_year = till_pension_age_parts(tab, age, gender,
+                                                               pension_age, nyears)
+    gender = np.broadcast_to(np.asarray(gender)[..., None], age_in_year.shape)
+    out[..., :nq.shape[-1]][till_pension_age] = (
+        lookup[gender[till_pension_age], age_in_year[till_pension_age]] *
+        nq[till_pension_age])
+    return out
+
+
+def cf_defined_one_year_risk(tab, age, gender, nyears):
+    """ Returns expected cashflows one year risk premium (defined partner),
+    see LifeTable.cf_defined_one_year_risk.
+
+    age and gender are broadcast against each other.
+    """
+    age, gender = np.broadcast_arrays(age, gender)
+    alpha1 = adjustment(tab, gender, 'partner', 'CX1')
+    qx = 1 - npx(tab.lx_array, gender, age + alpha1, 1)
+    cf = cf_ay_avg(tab, age, gender, nyears)
+    return cf * (qx * factor(tab, gender, 'partner'))[..., None]
+
+
+def cf_undefined_one_year_risk(tab, age, gender, nyears):
+    """ Returns expected cashflows one year risk premium (undefined partner),
+    see LifeTable.cf_undefined_one_year_risk.
+
+    age and gender are broadcast against each other.
+    """
+    age, gender = np.broadcast_arrays(age, gender)
+    hx_avg = (tab.hx_array[gender, age] + tab.hx_array[gender, age + 1]) / 2.
+    return hx_avg[..., None] * cf_defined_one_year_risk(tab, age, gender, nyears)
@@ -1,18 +1,27 @@
 from __future__ import print_function
 
 from collections import OrderedDict
+import os
+import threading
 
 import numpy as np
 import pandas as pd
-import openpyxl
 
+from factors.cache import (read_sheet, get_sheet_names, discount_factors, file_hash,
+                           content_key, rate_key, LRUCache, CASHFLOWS, DiskCache,
+                           read_arrays, write_arrays)
 from factors.settings import (UPAGE, LOWAGE, MAXAGE, INSURANCE_IDS,
-                              MALE, FEMALE, DATADIR)
-from factors.utils import (dictify, get_excel_filepath,
+                              UNDEFINED_PARTNER_IDS, MALE, FEMALE, GENDERS, DATADIR,
+                              CACHEDIR)
+from factors.utils import (dictify, get_excel_filepath, gender_index, lazy_property,
                            prae_to_continuous, merge_two_dicts,
-                           cartesian, expand, x_to_series)
-from factors.utils_extra import (read_generation_table,
-                                 flatten_generation_table)
+                           cartesian, array_to_frame, array_to_table, x_to_series,
+                           x_to_matrix, half_year_mask)
+from factors.utils_extra import (read_generation_table, read_qx_array, generation_qx,
+                                 generation_lx_array, lx_array_to_frame)
+from factors import cashflows as compact
+from factors import kernels
+from factors.writers import output_format, write_sheets
 
 REQUIRED_SHEETS = [
     'tbl_insurance_types',
@@ -22,6 +31,30 @@ REQUIRED_SHEETS = [
     'tbl_adjustments'
 ]  # optional: tbl_ukv and tbl_testdata
 
+LOOKUP_CACHE_SIZE = 16  # number of lookup tables (intrest rates) kept per LifeTable
+SURVIVAL_VERSION = 1  # bump when lx/hx arrays are calculated differently, see get_survival_arrays
+YEAR_CACHE_SIZE = 8  # number of lx arrays (calculation years) kept per LifeTable, see at_year
+
+# shared read-only LifeTables of LifeTable.get: {(tablename, calc_year, genders): LifeTable}
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def trim_years(cube, labels):
+    """ Returns cube and labels of cashflow_cube without the years at the end
+    in which nothing is paid.
+    """
+    nyears = np.flatnonzero(cube.any(axis=tuple(range(cube.ndim - 1)))).max() + 1
+    labels = OrderedDict(labels)
+    labels['year'] = labels['year'][:nyears]
+    return cube[..., :nyears], labels
+
+
+def columnar_labels(labels):
+    """ Returns labels of cashflow_cube with the column names of cashflow_table.
+    """
+    return OrderedDict(zip(['insurance_id', 'sex', 'age', 'year'], labels.values()))
+
 
 def get_available_tablenames():
     df = pd.read_csv(DATADIR + "/tables.csv")
@@ -36,41 +69,259 @@ class LifeTable(object):
         print(msg.format(self.excel_filepath))
         # TODO: make calc_year required if type(tablename) = generation
         self.calc_year = kwargs.get('calc_year', 2017)
-        self.legend = self.get_legend()
+        # generation tables are only flattened for these genders
+        self.genders = self.check_genders(kwargs.get('genders', GENDERS))
+        # optional persistent cache of cash flows and factors, see get_disk_cache
+        self.disk_cache = self.get_disk_cache(kwargs.get('disk_cache', None))
         self.params = self.get_parameters()
-        self.generation_table = self.read_generation_table()
-        self.sheet_names = self.get_sheet_names()
-        self.lx_table = self.get_lx_table()
         self.lx = self.get_lx  # no call as this function is called later!
         self.hx = self.get_hx()
+        self.lx_array, self.hx_array = self.get_survival_arrays()
         self.adjust = self.get_adjustments()
-        self.ukv = self.get_ukv() if 'tbl_ukv' in self.get_sheet_names() else None
-        self.testdata = self.get_testdata() if 'tbl_testdata' in self.get_sheet_names() else None
+        self.is_shared = False
+        # legend, sheet_names, generation_table, qx_array, lx_table, adjustments, ukv
+        # and testdata are read on first use
+        self.lookup_tables = LRUCache(maxsize=LOOKUP_CACHE_SIZE)
+        self.year_lx_arrays = LRUCache(maxsize=YEAR_CACHE_SIZE)
+        self.reset_state()
+
+    @classmethod
+    def from_arrays(cls, tablename, params, adjust, lx_array, hx_array,
+                    ukv=None, calc_year=2017):
+        """ Returns LifeTable with given arrays, without reading the workbook.
+
+        Meant for worker processes. Sheets like lx_table, legend or testdata
+        are still read from the workbook on first use.
+
+        Parameters:
+        -----------
+        tablename: str
+        params, adjust: dict, see get_parameters() and get_adjustments()
+        lx_array, hx_array: array, see get_lx_array() and get_hx_array()
+        ukv: DataFrame, see get_ukv(). Optional, read on first use if not given.
+        calc_year: int
+        """
+        self = cls.__new__(cls)
+        self.tablename = tablename
+        self.excel_filepath = get_excel_filepath(tablename=tablename)
+        self.calc_year = calc_year
+        self.genders = GENDERS
+        self.disk_cache = None
+        self.params = params
+        self.lx = self.get_lx
+        self.lx_array = lx_array
+        self.hx_array = hx_array
+        self.hx = {gender: pd.DataFrame({'hx': hx_array[i]},
+                                        index=pd.RangeIndex(hx_array.shape[-1], name='age'))
+                   for i, gender in enumerate(GENDERS)}
+        self.adjust = adjust
+        if ukv is not None:
+            self.ukv = ukv
+        self.is_shared = False
+        self.lookup_tables = LRUCache(maxsize=LOOKUP_CACHE_SIZE)
+        self.year_lx_arrays = LRUCache(maxsize=YEAR_CACHE_SIZE)
+        self.reset_state()
+        return self
+
+    @classmethod
+    def get(cls, tablename, calc_year=2017, genders=GENDERS, disk_cache=None):
+        """ Returns view on the shared LifeTable of given tablename and calc_year.
+
+        The table is read once per process and kept in a registry. Its lx/hx
+        arrays, adjustments and lookup tables are shared by all views, while
+        per-call state (pension_age, intrest, cfs, factors and yield_curve)
+        is kept in the view.
+
+        Parameters:
+        -----------
+        tablename: str
+        calc_year: int
+        genders: list. Genders of which generation tables are flattened.
+        disk_cache: None, True or DiskCache, see get_disk_cache. Set on the view only.
+        """
+        key = (tablename, calc_year, cls.check_genders(genders))
+        with _registry_lock:
+            core = _registry.get(key)
+            if core is None:
+                core = cls(tablename, calc_year=calc_year, genders=genders)
+                core.lx_array.flags.writeable = False
+                core.hx_array.flags.writeable = False
+                core.is_shared = True
+                core.cache_key()  # the hashes are computed once and shared by the views
+                _registry[key] = core
+        view = core.view()
+        view.disk_cache = cls.get_disk_cache(disk_cache)
+        return view
+
+    @staticmethod
+    def clear_registry():
+        """ Removes all shared LifeTables, see get().
+        """
+        with _registry_lock:
+            _registry.clear()
+
+    def view(self):
+        """ Returns LifeTable sharing the tables of self, without its per-call state.
+        """
+        out = self.__class__.__new__(self.__class__)
+        out.__dict__.update(self.__dict__)
+        out.lx = out.get_lx
+        out.reset_state()
+        return out
+
+    def at_year(self, calc_year):
+        """ Returns LifeTable for given calculation year, sharing the tables of self.
+
+        For generation tables the lx array is derived from the qx of all years
+        (qx_array) instead of reading the workbook again. The lx arrays of the
+        last YEAR_CACHE_SIZE calculation years are kept and shared by all views.
+        Flat tables do not depend on the calculation year.
+
+        Parameters:
+        -----------
+        calc_year: int
+        """
+        out = self.view()
+        if calc_year == self.calc_year:
+            return out
+        out.calc_year = calc_year
+        if not self.params['is_flat']:
+            out.lx_array = self.get_year_lx_array(calc_year)
+            for name in ('generation_table', 'lx_table', 'data_hash'):
+                out.__dict__.pop(name, None)
+            out.lookup_tables = LRUCache(maxsize=LOOKUP_CACHE_SIZE)
+        return out
+
+    def get_year_lx_array(self, calc_year):
+        """ Returns (read-only) lx array of given calculation year, see at_year.
+        """
+        lx_array = self.year_lx_arrays.get(calc_year)
+        if lx_array is None:
+            lx_array = self.get_lx_array(calc_year)
+            lx_array.flags.writeable = False
+            self.year_lx_arrays.put(calc_year, lx_array)
+        return lx_array
+
+    def reset_state(self):
+        """ Clears per-call state of calculate_cashflows and calculate_factors.
+        """
         self.pension_age = None
         self.intrest = None
-        self.lookup = None
         self.cfs = None
         self.factors = None
         self.yield_curve = None
 
+    @staticmethod
+    def get_disk_cache(disk_cache):
+        """ Returns DiskCache for argument disk_cache: None, True (default
+        location) or a DiskCache.
+        """
+        if disk_cache is None or disk_cache is False:
+            return None
+        return DiskCache() if disk_cache is True else disk_cache
+
+    @lazy_property
+    def content_hash(self):
+        """ Returns sha256 of the workbook, part of the keys of the disk cache.
+        """
+        return file_hash(self.excel_filepath)
+
+    @lazy_property
+    def data_hash(self):
+        """ Returns sha256 of the lx/hx arrays, parameters and adjustments the cash flows
+        are calculated from, part of the keys of cache.CASHFLOWS and the disk cache.
+
+        Computed on first use: tables made with from_arrays (e.g. with a shocked
+        lx array) get their own key, the lx/hx arrays should not change afterwards.
+        """
+        return content_key(self.lx_array, self.hx_array, self.params, self.adjust)
+
+    def disk_cache_key(self, kind, pension_age, intrest, *items):
+        """ Returns key in the disk cache of given result (kind) of this table.
+        """
+        return self.disk_cache.key(self.content_hash, self.data_hash, self.tablename,
+                                   self.calc_year, self.genders, kind, pension_age,
+                                   rate_key(intrest), *items)
+
+    @staticmethod
+    def check_genders(genders):
+        genders = tuple(gender for gender in GENDERS if gender in genders)
+        if not genders:
+            raise ValueError("genders should contain {0} and/or {1}".format(*GENDERS))
+        return genders
+
+    def check_lx_genders(self, insurance_id, gender):
+        """ Raises ValueError if the cash flows of insurance_id for given gender need
+        the lx of a gender of which the generation table is not flattened (see genders).
+
+        All insurance_ids but OPLL also need the lx of the beneficiary (opposite gender).
+
+        Parameters:
+        -----------
+        insurance_id: str
+        gender: int or array, index in GENDERS
+        """
+        if self.params['is_flat'] or len(self.genders) == len(GENDERS):
+            return
+        needed = set(np.unique(gender).tolist())
+        if insurance_id != 'OPLL':
+            needed |= set(len(GENDERS) - 1 - x for x in needed)
+        missing = [GENDERS[x] for x in sorted(needed) if GENDERS[x] not in self.genders]
+        if missing:
+            raise ValueError("{0} requires the lx of gender {1}, which is not in genders {2}"
+                             .format(insurance_id, ', '.join(missing), list(self.genders)))
+
+    @lazy_property
+    def sheet_names(self):
+        return self.get_sheet_names()
+
+    @lazy_property
+    def legend(self):
+        return self.get_legend()
+
+    @lazy_property
+    def generation_table(self):
+        return self.read_generation_table()
+
+    @lazy_property
+    def qx_array(self):
+        """ Returns qx of all years of the generation table as array [gender, age, year].
+        """
+        return read_qx_array(self.excel_filepath, self.params['lx'])
+
+    @lazy_property
+    def lx_table(self):
+        return self.get_lx_table()
+
+    @lazy_property
+    def adjustments(self):
+        """ Returns tbl_adjustments as DataFrame.
+        """
+        return read_sheet(self.excel_filepath, 'tbl_adjustments')
+
+    @lazy_property
+    def ukv(self):
+        return self.get_ukv() if 'tbl_ukv' in self.sheet_names else None
+
+    @lazy_property
+    def testdata(self):
+        return self.get_testdata() if 'tbl_testdata' in self.sheet_names else None
+
     def get_sheet_names(self):
-        wb = openpyxl.open(self.excel_filepath)
-        return wb.sheetnames
+        return get_sheet_names(self.excel_filepath)
 
     def xls_contains_all_required_sheets(self):
         return all(x in self.sheet_names for x in REQUIRED_SHEETS)
 
     def get_legend(self):
         sheet = 'tbl_insurance_types'
-        # TODO : Python 2 verwacht sheetname=sheet
-        df = pd.read_excel(self.excel_filepath, sheet_name=sheet)
+        df = read_sheet(self.excel_filepath, sheet)
         df.set_index('id_type', inplace=True)
         return df
 
     def get_parameters(self):
         sheet = 'tbl_tariff'
-        # TODO : Python 2 verwacht sheetname=sheet
-        df = pd.read_excel(self.excel_filepath, sheet_name=sheet)
+        df = read_sheet(self.excel_filepath, sheet)
         # to_dict("records") converts it to a list of dictionaries,
         # we just want the first item
         parameters = df.to_dict("records")
@@ -89,12 +340,12 @@ class LifeTable(object):
     def get_lx_table(self):
         if self.params['is_flat']:
             sheet = 'tbl_lx'
-            # TODO : Python 2 verwacht sheetname=sheet
-            df = pd.read_excel(self.excel_filepath, sheet_name=sheet)
+            df = read_sheet(self.excel_filepath, sheet)
             df.set_index(['gender', 'age'], inplace=True)
             out = {gender: df.loc[gender] for gender in (MALE, FEMALE)}
         else:
-            out = flatten_generation_table(self.generation_table)
+            out = {gender: lx_array_to_frame(self.lx_array[i])
+                   for i, gender in enumerate(GENDERS)}
         return out
 
     def get_lx(self, current_age):
@@ -106,49 +357,106 @@ class LifeTable(object):
             out = {gender: self.lx_table[gender].loc[current_age] for gender in [MALE, FEMALE]}
         return out
 
+    def get_lx_array(self, calc_year=None):
+        """ Returns lx_table as dense array.
+
+        Indexed by [gender, age] for flat tables and
+        by [gender, current_age, age] for generation tables.
+
+        Parameters:
+        -----------
+        calc_year: int, calculation year of generation tables. Default self.calc_year.
+        """
+        if self.params['is_flat']:
+            return np.stack([self.lx_table[gender]['lx'].to_numpy(dtype=float)
+                             for gender in GENDERS])
+        qx = generation_qx(self.qx_array, self.calc_year if calc_year is None else calc_year)
+        nages = qx.shape[1]
+        out = np.full((len(GENDERS), nages, nages), np.nan)
+        for i, gender in enumerate(GENDERS):
+            if gender in self.genders:
+                out[i] = generation_lx_array(qx[i])
+        return out
+
+    def get_survival_filepath(self):
+        """ Returns path of the memory mapped lx and hx arrays, see get_survival_arrays.
+        """
+        name = "{0}-{1}-{2}.lxhx".format(self.tablename, self.calc_year, ''.join(self.genders))
+        return os.path.join(CACHEDIR, name)
+
+    def get_survival_arrays(self):
+        """ Returns (lx_array, hx_array) as read-only memory mapped arrays.
+
+        The arrays are stored in get_survival_filepath() (see cache.write_arrays)
+        and only rebuilt when the workbook or SURVIVAL_VERSION changes. All
+        processes using the table share one copy in the page cache. If the file
+        cannot be written, the arrays are kept in memory.
+        """
+        filepath = self.get_survival_filepath()
+        try:
+            meta, arrays = read_arrays(filepath)
+            if (meta.get('sha256') == self.content_hash and
+                    meta.get('version') == SURVIVAL_VERSION):
+                return arrays['lx'], arrays['hx']
+        except (OSError, ValueError, KeyError):
+            pass
+        lx_array, hx_array = self.get_lx_array(), self.get_hx_array()
+        try:
+            os.makedirs(CACHEDIR, exist_ok=True)
+            write_arrays(filepath, OrderedDict([('lx', lx_array), ('hx', hx_array)]),
+                         meta={'sha256': self.content_hash, 'version': SURVIVAL_VERSION,
+                               'tablename': self.tablename,
+                               'calc_year': self.calc_year, 'genders': list(self.genders)})
+            arrays = read_arrays(filepath)[1]
+            return arrays['lx'], arrays['hx']
+        except OSError as e:
+            print("Could not write {0}: {1}".format(filepath, e))
+            return lx_array, hx_array
+
     def get_hx(self):
         sheet = 'tbl_hx'
-        # TODO : Python 2 verwacht sheetname=sheet
-        df = pd.read_excel(self.excel_filepath, sheet_name=sheet)
+        df = read_sheet(self.excel_filepath, sheet)
         df.set_index(['gender', 'age'], inplace=True)
         return {gender: df.loc[gender] for gender in (MALE, FEMALE)}
 
+    def get_hx_array(self):
+        """ Returns hx as dense array indexed by [gender, age].
+        """
+        return np.stack([self.hx[gender]['hx'].to_numpy(dtype=float)
+                         for gender in GENDERS])
+
     def get_adjustments(self):
-        sheet = 'tbl_adjustments'
-        # TODO : Python 2 verwacht sheetname=sheet
-        df = pd.read_excel(self.excel_filepath, sheet_name=sheet)
-        return dictify(df)
+        return dictify(self.adjustments)
 
     def get_ukv(self):
         sheet = 'tbl_ukv'
-        # TODO : Python 2 verwacht sheetname=sheet
-        df = pd.read_excel(self.excel_filepath, sheet_name=sheet)
+        df = read_sheet(self.excel_filepath, sheet)
         df.set_index(['gender', 'pension_age', 'intrest'], inplace=True)
         return df
 
     def get_testdata(self):
         sheet = 'tbl_testdata'
-        # TODO : Python 2 verwacht sheetname=sheet
-        return pd.read_excel(self.excel_filepath, sheet_name=sheet)
+        return read_sheet(self.excel_filepath, sheet)
 
     def npx(self, age, sex, nyears):
         """Returns probability person with given age is still alive after n years.
 
+        All parameters may also be arrays (broadcasted against each other),
+        in which case an array is returned.
+
         Parameters:
         -----------
         age: int
         sex: either 'M' of 'F'
         nyears: int
         """
-        future_age = np.minimum(age + nyears, MAXAGE)
-        current_age = np.minimum(age, MAXAGE)
-        lx = self.lx(current_age)
-        return (float(lx[sex].loc[future_age]['lx']) /
-                lx[sex].loc[current_age]['lx'])
+        return kernels.npx(self.lx_array, gender_index(sex), age, nyears)[()]
 
     def qx(self, age, sex):
         """Returns the probability that person with given age will die within 1 year.
 
+        Accepts arrays, see npx.
+
         Parameters:
         -----------
         age: int
@@ -160,6 +468,8 @@ class LifeTable(object):
         """Returns probability that person with will die
            in interval (nyears - 1, nyears).
 
+        Accepts arrays, see npx.
+
         Parameters:
         -----------
         age: int
@@ -203,6 +513,7 @@ class LifeTable(object):
         sign = 1 if sex_insured == MALE else -1
         gamma3 = self.adjust[sex_beneficiary][insurance_type]['CX3']
         current_age_beneficiary = age_insured - sign * delta + gamma3
+        kernels.check_ages(current_age_beneficiary)
         lx = self.lx(current_age_beneficiary)
         tbl_beneficiary = (lx[FEMALE]['lx'] if sex_insured == MALE
         else lx[MALE]['lx'])
@@ -236,25 +547,36 @@ class LifeTable(object):
         -----------
         intrest: int, float of Series.
         """
-        s = pd.DataFrame({'gender': (UPAGE - LOWAGE) * [MALE] +
-                                    (UPAGE - LOWAGE) * [FEMALE],
-                          'age': np.concatenate([np.arange(LOWAGE, UPAGE), np.arange(LOWAGE, UPAGE)])
-                          })
-        s['ay_avg'] = s.apply(lambda row: self.ay_avg(row['age'],
-                                                      row['gender'],
-                                                      intrest,
-                                                      rounding=False), axis=1)
-        s['hx_avg'] = s.apply(lambda row: (self.hx[row['gender']].loc[row['age']].values[0] +
-                                           self.hx[row['gender']].loc[row['age'] + 1].values[0]) / 2., axis=1)
-        s['alpha1'] = s.apply(lambda row: self.adjust[row['gender']]['partner']['CX1'], axis=1)
-        s['factor'] = s.apply(lambda row: self.adjust[row['gender']]['partner']['fnett'] *
-                                          self.adjust[row['gender']]['partner']['fcorr'] *
-                                          self.adjust[row['gender']]['partner']['fOTS'],
-                              axis=1)
+        nyears = self.lx_array.shape[-1]
+        ages = np.arange(LOWAGE, UPAGE)
+        gender = np.repeat(np.arange(len(GENDERS)), len(ages))
+        age = np.tile(ages, len(GENDERS))
+        s = pd.DataFrame({'gender': np.array(GENDERS)[gender], 'age': age})
+        s['ay_avg'] = kernels.cf_ay_avg(self, age, gender, nyears).dot(
+            discount_factors(intrest, nyears))
+        s['hx_avg'] = (self.hx_array[gender, age] + self.hx_array[gender, age + 1]) / 2.
+        s['alpha1'] = kernels.adjustment(self, gender, 'partner', 'CX1')
+        s['factor'] = kernels.factor(self, gender, 'partner')
         s['cf'] = s['ay_avg'] * s['hx_avg'] * s['factor']
         s.set_index(['gender', 'age'], inplace=True)
         return s
 
+    def get_lookup_table(self, intrest):
+        """ Returns lookup table for given intrest, see create_lookup_table.
+
+        The most recently used tables are cached per intrest rate or yield curve.
+
+        Parameters:
+        -----------
+        intrest: int, float of Series.
+        """
+        key = rate_key(intrest)
+        lookup = self.lookup_tables.get(key)
+        if lookup is None:
+            lookup = self.create_lookup_table(intrest)
+            self.lookup_tables.put(key, lookup)
+        return lookup
+
     def cf_retirement_pension(self, age_insured, sex_insured,
                               pension_age, **kwargs):
         """ Returns expected payments retirement pension.
@@ -266,29 +588,24 @@ class LifeTable(object):
         pension_age: int
 
         postnumerando: boolean
+
+        Calculated by kernels.cf_retirement_pension, see cf_array for a vector
+        of ages, sexes and pension ages.
         """
         postnumerando = (kwargs['postnumerando'] if
         'postnumerando' in kwargs else False)
-
-        alpha1 = self.adjust[sex_insured]['retire']['CX1']
-        alpha2 = self.adjust[sex_insured]['retire']['CX2']
-        lx = self.lx(age_insured + alpha2)
-        tbl_insured = lx[sex_insured]['lx']
-        fnett, fcorr, fOTS = (self.adjust[sex_insured]['retire'][item]
-                              for item in ['fnett', 'fcorr', 'fOTS'])
-        cf = self.cf_annuity(age_insured + alpha2, tbl_insured,
-                             defer=pension_age - age_insured + postnumerando)
-        cf = cf * self.npx(age_insured + alpha1, sex_insured,
-                           pension_age - age_insured)
-        cf = cf / self.npx(age_insured + alpha2, sex_insured,
-                           pension_age - age_insured)
-        cf = prae_to_continuous(cf)
-        return {'payments': cf * fnett * fcorr * fOTS}
+        nyears = self.lx_array.shape[-1]
+        cf = kernels.cf_retirement_pension(self, age_insured, gender_index(sex_insured),
+                                           pension_age, nyears, postnumerando)
+        return {'payments': pd.Series(cf, index=pd.RangeIndex(nyears, name='year'))}
 
     def cf_defined_partner(self, age_insured, sex_insured,
                            pension_age, **kwargs):
         """ Returns expected payments partner pension (defined partner).
 
+        Calculated by kernels.cf_defined_partner, see cf_array for a vector
+        of ages and sexes.
+
         Parameters:
         ----------
         age_insured: int
@@ -296,49 +613,10 @@ class LifeTable(object):
         pension_age: int
         """
         assert sex_insured in (MALE, FEMALE), "sex insured should be either M of F!"
-        sex_beneficiary = FEMALE if sex_insured == MALE else MALE
-
-        alpha1 = self.adjust[sex_insured]['partner']['CX1']
-        alpha2 = self.adjust[sex_insured]['partner']['CX2']
-        gamma3 = self.adjust[sex_beneficiary]['partner']['CX3']
-        sign = 1 if sex_insured == MALE else -1
-        delta = int(self.params['delta'])
-
-        current_age_alpha1 = age_insured + alpha1
-        current_age_alpha2 = age_insured + alpha2
-        current_age_beneficiary = age_insured - sign * delta + gamma3
-
-        lx_insured_alpha1 = self.lx(current_age_alpha1)
-        lx_insured_alpha2 = self.lx(current_age_alpha2)
-        lx_beneficiary = self.lx(current_age_beneficiary)
-
-        tbl_insured_alpha1 = lx_insured_alpha1[sex_insured]['lx']
-        tbl_insured_alpha2 = lx_insured_alpha2[sex_insured]['lx']
-        tbl_beneficiary = lx_beneficiary[sex_beneficiary]['lx']
-
-        fnett, fcorr, fOTS = (self.adjust[sex_insured]['partner'][item]
-                              for item in ['fnett', 'fcorr', 'fOTS'])
-
-        ay = self.cf_annuity(current_age_beneficiary,
-                             tbl_beneficiary)
-        ax = self.cf_annuity(current_age_alpha1, tbl_insured_alpha1)
-        axy = ax.multiply(ay)
-
-        f1 = self.cf_annuity(current_age_alpha1, tbl_insured_alpha1,
-                             pension_age - age_insured)
-        f1 = f1 * self.cf_annuity(current_age_beneficiary,
-                                  tbl_beneficiary, pension_age - age_insured)
-        f2 = self.cf_annuity(current_age_alpha2,
-                             tbl_insured_alpha2, pension_age - age_insured)
-        f2 = f2 * self.cf_annuity(current_age_beneficiary,
-                                  tbl_beneficiary, pension_age - age_insured)
-        temp1 = ((float(tbl_insured_alpha1.loc[pension_age + alpha1]) /
-                  tbl_insured_alpha1.loc[current_age_alpha1]))
-        temp2 = ((float(tbl_insured_alpha2.loc[current_age_alpha2]) /
-                  tbl_insured_alpha2.loc[pension_age + alpha2]))
-        f2 = f2 * temp1 * temp2
-        out = fnett * fcorr * fOTS * (ay - axy + (f1 - f2))
-        # print(ay, axy, f1, f2)
+        nyears = self.lx_array.shape[-1]
+        out = kernels.cf_defined_partner(self, age_insured, gender_index(sex_insured),
+                                         pension_age, nyears)
+        out = pd.Series(out, index=pd.RangeIndex(nyears, name='year'))
         return {'payments': out}
 
     def cf_undefined_partner(self, age_insured, sex_insured,
@@ -358,68 +636,47 @@ class LifeTable(object):
         hx_pd: either 'None' for non-exchangable, 'one' for exchangable
         or 'ukv' for Aegon methodology (depreciated).
 
+        Calculated by kernels.cf_undefined_partner, see cf_array for a vector
+        of ages, sexes and pension ages.
         """
         assert sex_insured in (MALE, FEMALE), "sex insured should be either M of F!"
 
         intrest = kwargs.get('intrest', None)
-        if (intrest is None):
-            msg1 = "Undefined partner cashflows require intrest"
-            msg2 = "-- defaults intrest = 3pct"
-            print("{0} {1}".format(msg1, msg2))
-            intrest = 3  # default = 3 pct intrest rate!
+        intrest = 3 if intrest is None else intrest  # default = 3 pct intrest rate!
+        hx_at_pensionage = self.hx_at_pension_age(sex_insured, pension_age,
+                                                  kwargs.get('hx_pd', None),
+                                                  kwargs.get('intrest', None))
+        nyears = self.lx_array.shape[-1] + max(pension_age - age_insured, 0)
+        cf = kernels.cf_undefined_partner(self, age_insured, gender_index(sex_insured),
+                                          pension_age, nyears, self.lookup_array(intrest),
+                                          hx_at_pensionage)
+        cf = pd.Series(cf, index=pd.RangeIndex(nyears, name='year'), name='cf')
+        return {'age': age_insured, 'pension_age': pension_age, 'payments': cf}
+
+    def hx_at_pension_age(self, sex_insured, pension_age, hx_pd=None, intrest=None):
+        """ Returns probability of having a partner at pension age (undefined partner).
 
-        hx_pd = kwargs.get('hx_pd', None)
+        Parameters:
+        ----------
+        sex_insured: either 'M' of 'F'
+        pension_age: int
+        hx_pd: either 'None' for non-exchangable, 'one' for exchangable
+        or 'ukv' for Aegon methodology (depreciated).
+        intrest: int or float, required for hx_pd='ukv'
+        """
         # by default, undefined partner pension is assumed to be exchangable
         if (hx_pd is None) or (hx_pd == 'one'):
             hx_at_pensionage = 1
         elif hx_pd == 'ukv':
             try:
                 hx_at_pensionage = self.ukv.loc[(sex_insured, pension_age,
-                                                kwargs['intrest'])].values[0]
+                                                intrest)].values[0]
             except:
                 print('Undefined partner cashflows require UKV -- defaults hx_pd = 1')
                 hx_at_pensionage = 1
         else:
             hx_at_pensionage = self.hx[sex_insured]['hx'].loc[pension_age]
-
-        fnett, fcorr, fOTS = (self.adjust[sex_insured]['partner'][item]
-                              for item in ['fnett', 'fcorr', 'fOTS'])
-
-        # cf till retirement
-        if intrest == self.intrest:
-            lookup = self.lookup
-        else:
-            lookup = self.create_lookup_table(intrest)
-            self.lookup = lookup
-            self.intrest = intrest
-
-        cf_till_pension_age = (lookup.loc[sex_insured].
-                                   loc[age_insured:pension_age - 1])
-        current_age = age_insured  # we need [k]q[current_age]
-        cf_till_pension_age['age'] = cf_till_pension_age.index
-        nq_current_age = cf_till_pension_age.apply(lambda row:
-                                                   self.nqx(current_age + row['alpha1'],
-                                                            sex_insured,
-                                                            row['age'] - current_age + 1),
-                                                   axis=1)
-        cf_till_pension_age = cf_till_pension_age['cf'] * nq_current_age
-        cf_till_pension_age = pd.DataFrame(cf_till_pension_age, columns=['cf'])
-
-        # cf after retirement
-        prob = self.npx(age_insured + lookup['alpha1'].loc[(sex_insured, age_insured)], sex_insured,
-                        pension_age - age_insured)
-        cf_defined_partner = self.cf_defined_partner(pension_age, sex_insured, pension_age)
-        cf_after_pension_age = hx_at_pensionage * prob * cf_defined_partner['payments']
-        cf_after_pension_age = pd.DataFrame(cf_after_pension_age, columns=['cf'])
-        cf_after_pension_age['age'] = cf_after_pension_age.index + pension_age
-        cf_after_pension_age.set_index('age', inplace=True)
-        ### as of pandas 2.0 append has been removed :  cf = cf_till_pension_age.append(cf_after_pension_age)
-        cf = pd.concat([cf_till_pension_age, cf_after_pension_age])
-        cf = pd.DataFrame(cf)
-        cf['year'] = range(len(cf))
-        cf.set_index('year', inplace=True)
-        cf = pd.Series(cf['cf'])
-        return {'age': age_insured, 'pension_age': pension_age, 'payments': cf}
+        return hx_at_pensionage
 
     def cf_defined_one_year_risk(self, age_insured, sex_insured, pension_age, **kwargs):
         """ Ruturns expected cashflows one year risk premium (defined partner).
@@ -435,14 +692,11 @@ class LifeTable(object):
         # fnett, fcorr, fOTS = (self.adjust[sex_insured]['risk'][item]
         #                      for item in ['fnett', 'fcorr', 'fOTS'])
         #  --- risk premiums are considered to be part of partnerpension, so its adjustments are used! ---
-        alpha1 = self.adjust[sex_insured]['partner']['CX1']
-        fnett, fcorr, fOTS = (self.adjust[sex_insured]['partner'][item]
-                              for item in ['fnett', 'fcorr', 'fOTS'])
         assert sex_insured in (MALE, FEMALE), "sex insured should be either M of F!"
-
-        cf = self.cf_ay_avg(age_insured, sex_insured, insurance_type='partner')
-        qx = self.qx(age_insured + alpha1, sex_insured)
-        cf = cf['payments'] * qx * fnett * fcorr * fOTS
+        nyears = self.lx_array.shape[-1]
+        cf = kernels.cf_defined_one_year_risk(self, age_insured, gender_index(sex_insured),
+                                              nyears)
+        cf = pd.Series(cf, index=pd.RangeIndex(nyears, name='year'))
         return {'insurance_id': 'NPTL-B', 'payments': cf}
 
     def cf_undefined_one_year_risk(self, age_insured, sex_insured, pension_age, **kwargs):
@@ -455,11 +709,10 @@ class LifeTable(object):
         sex_insured: either 'M' of 'F'
         pension_age: int
         """
-
-        hx_avg = (self.hx[sex_insured].loc[age_insured].values[0] + self.hx[sex_insured].loc[age_insured + 1].values[
-            0]) / 2.
-        cf_defined_one_year_risk = self.cf_defined_one_year_risk(age_insured, sex_insured, pension_age, **kwargs)
-        cf = hx_avg * cf_defined_one_year_risk['payments']
+        nyears = self.lx_array.shape[-1]
+        cf = kernels.cf_undefined_one_year_risk(self, age_insured, gender_index(sex_insured),
+                                                nyears)
+        cf = pd.Series(cf, index=pd.RangeIndex(nyears, name='year'))
         return {'insurance_id': 'NPTL-O', 'payments': cf}
 
     def cf(self, insurance_id, age_insured, sex_insured, pension_age, **kwargs):
@@ -484,6 +737,7 @@ class LifeTable(object):
                     'NPTL-O': {'call': self.cf_undefined_one_year_risk, 'hx_pd': None},
                     'ay_avg': {'call': self.cf_ay_avg, 'hx_pd': None}
                     }
+        self.check_lx_genders(insurance_id, gender_index(sex_insured))
 
         out = merge_two_dicts({'insurance_id': insurance_id},
                               switcher[insurance_id]['call'](age_insured,
@@ -493,37 +747,281 @@ class LifeTable(object):
                                                              **kwargs))
         return out
 
+    def lookup_array(self, intrest):
+        """ Returns column 'cf' of the lookup table as array indexed by [gender, age].
+
+        Parameters:
+        -----------
+        intrest: int, float of Series.
+        """
+        lookup = self.get_lookup_table(intrest)['cf']
+        out = np.full((len(GENDERS), MAXAGE + 1), np.nan)
+        out[gender_index(lookup.index.get_level_values('gender')),
+            lookup.index.get_level_values('age')] = lookup.values
+        return out
+
+    def cf_array(self, insurance_id, ages, sex_insured, pension_age, nyears, **kwargs):
+        """ Returns cash flows for given insurance type for an array of ages.
+
+        Equal to cf(), but returns an array of shape (len(ages), nyears).
+
+        Parameters:
+        -----------
+        insurance_id: either 'OPLL', 'NPLL-B', 'NPLL-O', 'NPLLRS', 'NPLLRU', 'NPTL-B',
+        'NPTL-O' or 'ay_avg'
+        ages: array of int
+        sex_insured: either 'M' of 'F', or array broadcastable with ages
+        pension_age: int or array broadcastable with ages
+        nyears: int, number of years of cash flows
+
+        intrest: int, float or Series. Optional. Default 3pct.
+        lookup: array, see lookup_array(). Optional.
+        out: array (len(ages), nyears) the cash flows of the undefined partner pensions
+        are written to. Optional.
+        """
+        ages = np.asarray(ages)
+        gender = gender_index(sex_insured)
+        self.check_lx_genders(insurance_id, gender)
+        if insurance_id == 'OPLL':
+            return kernels.cf_retirement_pension(self, ages, gender, pension_age, nyears,
+                                                 kwargs.get('postnumerando', False))
+        elif insurance_id == 'NPLL-B':
+            return kernels.cf_defined_partner(self, ages, gender, pension_age, nyears)
+        elif insurance_id in ['NPLL-O', 'NPLLRS', 'NPLLRU']:
+            intrest = kwargs.get('intrest', None)
+            intrest = 3 if intrest is None else intrest
+            lookup = kwargs.get('lookup', None)
+            lookup = self.lookup_array(intrest) if lookup is None else lookup
+            hx_pd = {'NPLL-O': 'non-exchangable', 'NPLLRS': 'one', 'NPLLRU': 'ukv'}
+            unique, inverse = kernels.unique_index(gender, pension_age)
+            hx_at_pension_age = np.array([
+                self.hx_at_pension_age(GENDERS[g], pa, hx_pd[insurance_id], intrest)
+                for g, pa in unique], dtype=float)[inverse]
+            return kernels.cf_undefined_partner(self, ages, gender, pension_age, nyears,
+                                                lookup, hx_at_pension_age,
+                                                kwargs.get('out', None))
+        elif insurance_id == 'NPTL-B':
+            return kernels.cf_defined_one_year_risk(self, ages, gender, nyears)
+        elif insurance_id == 'NPTL-O':
+            return kernels.cf_undefined_one_year_risk(self, ages, gender, nyears)
+        elif insurance_id == 'ay_avg':
+            return kernels.cf_ay_avg(self, ages, gender, nyears)
+        raise ValueError("cannot process insurance_id: {0}".format(insurance_id))
+
+    def ay_avg_array(self, intrest):
+        """ Returns column 'ay_avg' of the lookup table as array indexed by [gender, age],
+        zero for ages outside the lookup table.
+
+        Parameters:
+        -----------
+        intrest: int, float of Series.
+        """
+        ay_avg = self.get_lookup_table(intrest)['ay_avg']
+        out = np.zeros((len(GENDERS), MAXAGE + 1))
+        out[gender_index(ay_avg.index.get_level_values('gender')),
+            ay_avg.index.get_level_values('age')] = ay_avg.values
+        return out
+
+    def cashflow_parts(self, insurance_id, pension_age):
+        """ Returns the parts of the cash flows of cashflow_cube that do not depend on intrest.
+
+        Returns dict with 'fixed': array (sex, age, year). For the undefined partner
+        pensions also 'weights' and 'age_in_year': arrays (sex, age, year), with the
+        cash flows fixed + ay_avg[sex, age_in_year] * weights (see ay_avg_array).
+
+        The parts are kept in cache.CASHFLOWS per (table, calc_year, pension_age,
+        insurance_id), see invalidate_cashflows.
+
+        Parameters:
+        -----------
+        insurance_id: str, any of INSURANCE_IDS
+        pension_age: int
+        """
+        if insurance_id == 'NPLLRU':
+            raise ValueError("NPLLRU depends on intrest through tbl_ukv and cannot be split")
+        key = self.cache_key() + (pension_age, insurance_id)
+        parts = CASHFLOWS.get(key)
+        if parts is not None:
+            return parts
+        ages = np.arange(LOWAGE, UPAGE)
+        # undefined partner cash flows start with the years till pension age
+        nyears = self.lx_array.shape[-1] + max(pension_age - LOWAGE, 0)
+        shape = (len(GENDERS), len(ages), nyears)
+        parts = {'fixed': np.zeros(shape)}
+        if insurance_id in UNDEFINED_PARTNER_IDS:
+            parts['weights'] = np.zeros(shape)
+            parts['age_in_year'] = np.zeros(shape, dtype=int)
+        if insurance_id not in UNDEFINED_PARTNER_IDS:
+            parts['fixed'][:] = self.cf_array(insurance_id, ages, np.array(GENDERS)[:, None],
+                                              pension_age, nyears)
+        else:
+            hx_pd = 'non-exchangable' if insurance_id == 'NPLL-O' else 'one'
+            gender = np.arange(len(GENDERS))[:, None]
+            self.check_lx_genders(insurance_id, gender)
+            hx_at_pension_age = np.array([self.hx_at_pension_age(sex, pension_age, hx_pd)
+                                          for sex in GENDERS], dtype=float)[:, None]
+            till_pension_age, nq, age_in_year, parts['fixed'][:] = (
+                kernels.undefined_partner_parts(self, ages, gender, pension_age, nyears,
+                                                hx_at_pension_age))
+            # the lookup table holds ay_avg * hx_avg * factor
+            hx_age = np.minimum(age_in_year, self.hx_array.shape[-1] - 2)
+            hx_avg = (self.hx_array[gender[..., None], hx_age] +
+                      self.hx_array[gender[..., None], hx_age + 1]) / 2.
+            factor = kernels.factor(self, gender, 'partner')[..., None]
+            parts['weights'][:] = np.where(till_pension_age, nq * hx_avg * factor, 0.)
+            parts['age_in_year'][:] = age_in_year
+        for part in parts.values():
+            part.flags.writeable = False
+        CASHFLOWS.put(key, parts)
+        return parts
+
+    def cache_key(self):
+        """ Returns key of this table in cache.CASHFLOWS.
+
+        Besides the name of the table it holds the hashes of the workbook and of
+        the data the cash flows are calculated from (see data_hash), so changed
+        workbooks and tables made with from_arrays do not share cash flows.
+        """
+        return (self.tablename, self.calc_year, self.genders, self.content_hash,
+                self.data_hash)
+
+    def invalidate_cashflows(self, pension_age=None):
+        """ Removes cash flows of this table (and given pension_age) from cache.CASHFLOWS.
+
+        Returns number of removed items.
+        """
+        key = self.cache_key()
+        return CASHFLOWS.invalidate(lambda x: x[:len(key)] == key and
+                                    (pension_age is None or x[len(key)] == pension_age))
+
+    def cashflow_cube(self, pension_age, intrest=3, insurance_ids=INSURANCE_IDS):
+        """ Returns cash flows of all insurance_ids, sexes and ages as one array.
+
+        The array has shape (insurance_id, sex, age, year) and matches
+        calculate_cashflows(), with cash flows padded with zeros to equal length.
+        The second item returned is an OrderedDict with the labels of each axis.
+
+        The cash flows are assembled from cashflow_parts(), so a change of
+        intrest only reprices the undefined partner pensions. With a disk cache
+        (see get_disk_cache) the cube is a read-only memory mapped array.
+
+        Parameters:
+        -----------
+        pension_age: int
+        intrest: int, float or Series. Default 3 pct.
+        insurance_ids: list of str. Default all INSURANCE_IDS.
+        """
+        ages = np.arange(LOWAGE, UPAGE)
+        labels = OrderedDict([('insurance_id', list(insurance_ids)),
+                              ('sex_insured', list(GENDERS)),
+                              ('age_insured', ages)])
+        if self.disk_cache is not None:
+            key = self.disk_cache_key('cube', pension_age, intrest, tuple(insurance_ids))
+            cached = self.disk_cache.get(key)
+            if cached is not None:
+                labels['year'] = np.arange(cached['cube'].shape[-1])
+                return cached['cube'], labels
+        nyears = self.lx_array.shape[-1] + max(pension_age - LOWAGE, 0)
+        ay_avg = None
+        if any(x in UNDEFINED_PARTNER_IDS for x in insurance_ids):
+            ay_avg = self.ay_avg_array(intrest)
+        cube = np.zeros((len(insurance_ids), len(GENDERS), len(ages), nyears))
+        for i, insurance_id in enumerate(insurance_ids):
+            if insurance_id == 'NPLLRU':
+                for j, sex in enumerate(GENDERS):
+                    cube[i, j] = self.cf_array(insurance_id, ages, sex, pension_age, nyears,
+                                               intrest=intrest)
+                continue
+            parts = self.cashflow_parts(insurance_id, pension_age)
+            cube[i] = parts['fixed']
+            if 'weights' in parts:
+                gender = np.arange(len(GENDERS))[:, None, None]
+                cube[i] += ay_avg[gender, parts['age_in_year']] * parts['weights']
+        labels['year'] = np.arange(nyears)
+        if self.disk_cache is not None:
+            self.disk_cache.put(key, {'cube': cube})
+        return cube, labels
+
     def pv(self, cf, intrest, rounding=False):
         """ Returns present value of cash flows.
 
         Parameters:
         -----------
-        cf: dict {'insurance_id: str, 'payments': series, 'age': int, 'pension_age': int}
+        cf: dict {'insurance_id: str, 'payments': series or cashflows.CashFlow, 'age': int,
+        'pension_age': int}
         intrest: int, float or series
         """
         cfs = cf['payments']
         insurance_id = cf['insurance_id']
-        year = pd.Series(cfs.index)
-        self.yield_curve = x_to_series(intrest, len(cfs))
+        nyears = len(cfs)
 
         if insurance_id in ['OPLL', 'NPLL-B', 'ay_avg']:
-            pv_factors = self.yield_curve.map(lambda r: 1. / (1 + r / 100.)) ** year
+            pv_factors = discount_factors(intrest, nyears)
         elif insurance_id in ['NPTL-B', 'NPTL-O']:
-            pv_factors = self.yield_curve.map(lambda r: 1. / (1 + r / 100.)) ** (year + 0.5)
+            pv_factors = discount_factors(intrest, nyears, 0.5)
         elif insurance_id in ['NPLL-O', 'NPLLRS', 'NPLLRU']:
             nyears_till_pension_age = cf['pension_age'] - cf['age']
-            year = year + 0.5 * (year <= nyears_till_pension_age)
-            pv_factors = self.yield_curve.map(lambda r: 1. / (1 + r / 100.)) ** year
+            pv_factors = np.where(np.arange(nyears) <= nyears_till_pension_age,
+                                  discount_factors(intrest, nyears, 0.5),
+                                  discount_factors(intrest, nyears))
         else:
-            print("---ERROR: cannot process insurance_id: {0}".format(insurance_id))
+            raise ValueError("cannot process insurance_id: {0}".format(insurance_id))
 
-        present_value = sum(cfs * pv_factors)
+        if isinstance(cfs, compact.CashFlow):
+            present_value = cfs.dot(pv_factors)
+        else:
+            present_value = np.dot(np.asarray(cfs, dtype=float), pv_factors)
         if rounding:
             rounding = self.params['round']
             return round(present_value, rounding)
         else:
             return present_value
 
+    def pv_batch(self, cashflows, curves, insurance_id, age=None, pension_age=None):
+        """ Returns present values of many cash flows for many yield curves.
+
+        Cash flows are discounted with the timing convention of their insurance_id
+        (see utils.half_year_mask) by a single matrix multiplication.
+
+        Parameters:
+        -----------
+        cashflows: array (..., nyears), for example the cube of cashflow_cube(), or
+        (list or object array of) cashflows.CashFlow, which are discounted without
+        padding them with zeros
+        curves: int, float, list or Series for a single curve, or
+        2-D array / DataFrame (n_scenarios, n_years) with intrest in pct.
+        Curves are padded with their last rate to nyears.
+        insurance_id: str or array of str, broadcastable to cashflows.shape[:-1]
+        age: int or array. Required for undefined partner pension.
+        pension_age: int or array. Required for undefined partner pension.
+
+        Returns array (n_scenarios, ...) for 2-D curves, else array (...).
+        """
+        sparse = compact.is_cashflows(cashflows)
+        if sparse:
+            cashflows = compact.as_cashflow_array(cashflows)
+            nyears = max(len(x) for x in cashflows.flat)
+        else:
+            cashflows = np.asarray(cashflows, dtype=float)
+            nyears = cashflows.shape[-1]
+        rates = x_to_matrix(curves, nyears)
+        year = np.arange(nyears)
+        v = 1. / (1 + rates / 100.)
+        discount = np.concatenate([v ** year, v ** (year + 0.5)], axis=1)
+
+        if sparse:
+            out = compact.present_values(cashflows, discount, insurance_id, age, pension_age)
+        else:
+            mid_year = half_year_mask(insurance_id, age, pension_age, nyears)
+            weighted = np.concatenate([np.where(mid_year, 0., cashflows),
+                                       np.where(mid_year, cashflows, 0.)], axis=-1)
+            batch_shape = weighted.shape[:-1]
+            out = weighted.reshape(-1, 2 * nyears).dot(discount.T)
+            out = out.T.reshape((len(rates),) + batch_shape)
+        if np.ndim(curves) < 2:
+            out = out[0]
+        return out
+
     def run_test(self):
         """ Performs tariff calulations on testdata.
 
@@ -538,19 +1036,17 @@ class LifeTable(object):
                             "Calculating present value of cash flows...",
                             "Sum of Errors Squared = ")
         print(msg1)
-        testdata = self.testdata
-        map_to_cashflows = lambda row: self.cf(insurance_id=row['insurance_id'],
-                                               age_insured=row['age'],
-                                               sex_insured=row['sex'],
-                                               pension_age=row['pension_age'],
-                                               intrest=row['intrest'])
-        map_to_present_value = lambda row: self.pv(cf=row['cf'], intrest=row['intrest'])
-
-        testdata['cf'] = testdata.apply(map_to_cashflows, axis=1)
+        testdata = self.testdata.copy()
+        map_to_present_value = lambda row: self.pv(cf=self.cf(insurance_id=row['insurance_id'],
+                                                              age_insured=row['age'],
+                                                              sex_insured=row['sex'],
+                                                              pension_age=row['pension_age'],
+                                                              intrest=row['intrest']),
+                                                   intrest=row['intrest'])
+
         print(msg2)
         testdata['calculated'] = testdata.apply(map_to_present_value, axis=1)
         testdata['difference'] = testdata['test_value'] - testdata['calculated']
-        del testdata['cf']
         error_squared = sum(testdata['difference'] * testdata['difference'])
         print(msg3),
         print(error_squared)
@@ -575,85 +1071,241 @@ class LifeTable(object):
             calculated = self.pv(cfs, row.intrest)
             print("#{0} -- {1} -- {2}".format(row.Index, row.insurance_id, row.test_value - calculated))
 
-    def calculate_cashflows(self, pension_age, intrest=3):
+    def get_cashflows(self, pension_age, intrest=3, cfs=None, sparse=False):
         """ Returns table with cashflows per insurance_id and age.
 
+        The cash flows (column 'cf') are dicts as returned by cf(), with the
+        payments taken from cashflow_cube. With sparse=True the payments are
+        stored as cashflows.CashFlow: without the zero payments before the first
+        and after the last payment.
+
+        Unlike calculate_cashflows, the result is not stored on the instance,
+        so it can be called concurrently on a shared LifeTable.
+
         Parameters:
         -----------
         pension_age: int
         intrest: int, float or Series. Default 3 pct.
+        cfs: DataFrame, cash flows of the same pension_age at another intrest.
+        Optional. If given, only the undefined partner pensions are recalculated.
+        sparse: bool, if True payments are cashflows.CashFlow instead of Series
+        indexed by year. Default False.
         """
-
-        # create table layout with all desired tariff combinations
-        df = cartesian(lists=[INSURANCE_IDS, [MALE, FEMALE], range(LOWAGE, UPAGE)],
-                       colnames=['insurance_id', 'sex_insured', 'age_insured'])
+        if cfs is not None:
+            df = cfs.copy()
+            insurance_ids = [x for x in INSURANCE_IDS if x in UNDEFINED_PARTNER_IDS]
+        else:
+            # create table layout with all desired tariff combinations
+            df = cartesian(lists=[INSURANCE_IDS, [MALE, FEMALE], range(LOWAGE, UPAGE)],
+                           colnames=['insurance_id', 'sex_insured', 'age_insured'])
+            insurance_ids = INSURANCE_IDS
+        rows = df['insurance_id'].isin(insurance_ids).values
 
         # generate cashflows
-        def map_to_cf(row):
-            return self.cf(insurance_id=row['insurance_id'],
-                           age_insured=row['age_insured'],
-                           sex_insured=row['sex_insured'],
-                           pension_age=pension_age,
-                           intrest=intrest)
-
-        df['cf'] = df.apply(map_to_cf, axis=1)
+        cube, labels = self.cashflow_cube(pension_age, intrest, insurance_ids)
+        index = (df.loc[rows, 'insurance_id'].map(insurance_ids.index).values,
+                 gender_index(df.loc[rows, 'sex_insured'].values),
+                 df.loc[rows, 'age_insured'].values - LOWAGE)
+        ages = df.loc[rows, 'age_insured'].values
+        # as cf(): the undefined partner pensions start with the years till pension age
+        undefined = df.loc[rows, 'insurance_id'].isin(UNDEFINED_PARTNER_IDS).values
+        nyears = self.lx_array.shape[-1] + np.where(undefined,
+                                                    np.maximum(pension_age - ages, 0), 0)
+        if sparse:
+            payments = [compact.CashFlow.from_array(cf[:n])
+                        for cf, n in zip(cube[index], nyears)]
+        else:
+            payments = [pd.Series(cf[:n], index=pd.RangeIndex(n, name='year'))
+                        for cf, n in zip(cube[index], nyears)]
+        df.loc[rows, 'cf'] = pd.Series(
+            [{'insurance_id': insurance_id, 'age': age, 'pension_age': pension_age,
+              'payments': payment}
+             for insurance_id, age, payment in zip(df.loc[rows, 'insurance_id'], ages,
+                                                   payments)],
+            index=df.index[rows], dtype=object)
+        if cfs is not None:
+            # kept cash flows in the other representation
+            convert = ~rows & np.array([isinstance(cf['payments'], compact.CashFlow) != sparse
+                                        for cf in df['cf']])
+            df.loc[convert, 'cf'] = pd.Series(
+                [dict(cf, payments=compact.as_payments(cf['payments'], sparse))
+                 for cf in df.loc[convert, 'cf']], index=df.index[convert], dtype=object)
+        return df
+
+    def get_factors(self, intrest, pension_age=67, cfs=None):
+        """ Returns factors, without storing them on the instance.
+
+        Parameters:
+        -----------
+        intrest: int, float or Series.
+        pension_age: int. Default 67 year.
+        cfs: DataFrame, see get_cashflows. Calculated if not given.
+        """
+        if cfs is None:
+            cfs = self.get_cashflows(pension_age=pension_age, intrest=intrest, sparse=True)
+        factors = cfs.copy(deep=True)
+        factors['tar'] = factors.apply(lambda row: self.pv(row['cf'], intrest=intrest), axis=1)
+        factors.set_index(['insurance_id', 'sex_insured', 'age_insured'], inplace=True)
+        factors.drop('cf', inplace=True, axis=1)
+        return factors
+
+    def calculate_cashflows(self, pension_age, intrest=3, sparse=False):
+        """ Returns table with cashflows per insurance_id and age and
+        stores it as self.cfs.
+
+        Parameters:
+        -----------
+        pension_age: int
+        intrest: int, float or Series. Default 3 pct.
+        sparse: bool, if True payments are cashflows.CashFlow, see get_cashflows.
+        Default False.
+        """
+        # cash flows not depending on intrest are kept if only intrest changes
+        cfs = self.cfs if pension_age == self.pension_age else None
+        df = self.get_cashflows(pension_age=pension_age, intrest=intrest, cfs=cfs,
+                                sparse=sparse)
         self.intrest = intrest
         self.pension_age = pension_age
         self.cfs = df
         return df
 
+    def has_cashflows(self, intrest, pension_age):
+        """ Returns True if self.cfs holds the cash flows of given intrest and pension_age.
+
+        Parameters:
+        -----------
+        intrest: int, float, list or Series.
+        pension_age: int
+        """
+        return (self.cfs is not None and pension_age == self.pension_age and
+                rate_key(intrest) == rate_key(self.intrest))
+
     def calculate_factors(self, intrest, pension_age=67):
-        """ Returns factors.
+        """ Returns factors and stores them as self.factors.
+
+        With a disk cache (see get_disk_cache) factors calculated before, also by
+        other processes or runs, are read from disk. In that case self.cfs
+        is not calculated.
 
         Parameters:
         -----------
         intrest: int, float or Series.
         pension_age: int. Default 67 year.
         """
-        if (intrest == self.intrest) and (pension_age == self.pension_age):
-            factors = self.cfs
-        else:
-            self.cfs = self.calculate_cashflows(intrest=intrest, pension_age=pension_age)
-            factors = self.cfs.copy(deep=True)
-        factors['tar'] = factors.apply(lambda row: self.pv(row['cf'], intrest=intrest), axis=1)
-        factors.set_index(['insurance_id', 'sex_insured', 'age_insured'], inplace=True)
-        factors.drop('cf', inplace=True, axis=1)
+        factors = None
+        if self.disk_cache is not None and not self.has_cashflows(intrest, pension_age):
+            key = self.disk_cache_key('factors', pension_age, intrest)
+            cached = self.disk_cache.get(key)
+            if cached is not None:
+                index = pd.MultiIndex.from_product(
+                    [INSURANCE_IDS, [MALE, FEMALE], range(LOWAGE, UPAGE)],
+                    names=['insurance_id', 'sex_insured', 'age_insured'])
+                factors = pd.DataFrame({'tar': np.array(cached['tar'])}, index=index)
+        if factors is None:
+            if not self.has_cashflows(intrest, pension_age):
+                self.calculate_cashflows(intrest=intrest, pension_age=pension_age)
+            factors = self.get_factors(intrest, pension_age=pension_age, cfs=self.cfs)
+            if self.disk_cache is not None:
+                key = self.disk_cache_key('factors', pension_age, intrest)
+                self.disk_cache.put(key, {'tar': factors['tar'].values})
         self.factors = factors
+        self.yield_curve = x_to_series(intrest, MAXAGE + 1)
         return factors
 
-    def export(self, xlswb, intrest, pension_age=67):
-        """ Exports results to given xlswb.
+    def cube_factors(self, cube, labels, intrest, pension_age):
+        """ Returns present values of the cash flows of cashflow_cube().
+
+        Parameters:
+        -----------
+        cube, labels: see cashflow_cube()
+        intrest: int, float or Series.
+        pension_age: int
+
+        Returns array (insurance_id, sex, age).
+        """
+        insurance_ids = np.array(labels['insurance_id'])[:, None, None]
+        ages = np.asarray(labels['age_insured'])[None, None, :]
+        return self.pv_batch(cube, intrest, insurance_ids, ages, pension_age)
+
+    def cashflow_table(self, pension_age, intrest=3, sparse=False):
+        """ Returns cash flows in long (columnar) format.
+
+        One row per insurance_id, sex, age and year with the payment as float64,
+        see utils.array_to_table. Use writers.write_table to store it as
+        parquet, feather or arrow file.
+
+        Parameters:
+        -----------
+        pension_age: int
+        intrest: int, float or Series. Default 3 pct.
+        sparse: bool, if True only the years from the first till the last payment
+        of each cash flow are included (see cashflows.to_table). Default False.
+        """
+        cube, labels = trim_years(*self.cashflow_cube(pension_age, intrest))
+        if sparse:
+            return compact.to_table(compact.from_array(cube), columnar_labels(labels),
+                                    'payment')
+        return array_to_table(cube, columnar_labels(labels), 'payment')
+
+    def factor_table(self, intrest, pension_age=67):
+        """ Returns factors in long (columnar) format: one row per insurance_id,
+        sex and age with the factor as float64.
 
         Parameters:
         -----------
-        xlswb: str
         intrest: int, float or Series.
         pension_age: int. Default 67 year.
         """
-        if (intrest == self.intrest) and (pension_age == self.pension_age):
-            result = self.factors
-        else:
-            result = self.calculate_factors(intrest=intrest, pension_age=pension_age)
+        cube, labels = self.cashflow_cube(pension_age, intrest)
+        factors = self.cube_factors(cube, labels, intrest, pension_age)
+        return array_to_table(factors, OrderedDict(list(columnar_labels(labels).items())[:3]),
+                              'factor')
+
+    def export(self, filepath, intrest, pension_age=67, sparse=False):
+        """ Exports results to given xlsx, csv, parquet, feather or arrow file.
+
+        The cash flows and factors are calculated with cashflow_cube().
+        An xlsx workbook is streamed to disk sheet by sheet. For the other
+        formats each sheet is written to its own file (see
+        writers.write_sheets), with cash flows and factors in the long
+        format of cashflow_table and factor_table.
+
+        Parameters:
+        -----------
+        filepath: str, with extension xlsx, csv, parquet, feather or arrow
+        intrest: int, float or Series.
+        pension_age: int. Default 67 year.
+        sparse: bool, if True the cash flows in long format only hold the years from
+        the first till the last payment (see cashflow_table). Default False.
+        """
+        cube, labels = trim_years(*self.cashflow_cube(pension_age, intrest))
+        factors = self.cube_factors(cube, labels, intrest, pension_age)
 
         sheets = OrderedDict()
         sheets['legend'] = self.legend
-        sheets['factors'] = result.unstack(['sex_insured', 'insurance_id'])
-        temp = self.cfs.copy(deep=True)
-        temp['cf'] = temp['cf'].map(lambda x: x['payments'])
-        cashflows = expand(temp, 'cf')
-        cashflows.set_index(['sex_insured', 'insurance_id', 'age_insured', 'year'], inplace=True)
-        sheets['cashflows'] = cashflows.unstack(['sex_insured', 'insurance_id'])
-        sheets['yield_curve'] = pd.DataFrame(self.yield_curve, columns=['intrest'])
-        sheets['lx'] = pd.concat([self.lx_table[MALE], self.lx_table[FEMALE]], axis=1)
-        sheets['hx'] = pd.concat([self.hx[MALE], self.hx[FEMALE]], axis=1)
-        # TODO : Python 2 verwacht sheetname=sheet
-        sheets['adjustments'] = pd.read_excel(self.excel_filepath, sheet_name='tbl_adjustments')
-
-        # write everything to Excel
-        writer = pd.ExcelWriter(xlswb)
-        for sheet_name, content in sheets.items():
-            content.to_excel(writer, sheet_name)
-        writer.close()
-
-        msg = "Ready. See {0} for output".format(xlswb)
+        if output_format(filepath) == 'xlsx':
+            factors_labels = OrderedDict(list(labels.items())[:3])
+            sheets['factors'] = (array_to_frame(factors, factors_labels, 'tar').
+                                 unstack(['sex_insured', 'insurance_id']))
+            sheets['cashflows'] = (array_to_frame(cube, labels, 'cf').
+                                   unstack(['sex_insured', 'insurance_id']))
+        else:
+            labels = columnar_labels(labels)
+            sheets['factors'] = array_to_table(factors, OrderedDict(list(labels.items())[:3]),
+                                               'factor')
+            if sparse:
+                sheets['cashflows'] = compact.to_table(compact.from_array(cube), labels,
+                                                       'payment')
+            else:
+                sheets['cashflows'] = array_to_table(cube, labels, 'payment')
+        sheets['yield_curve'] = pd.DataFrame(x_to_series(intrest, MAXAGE + 1),
+                                             columns=['intrest'])
+        sheets['lx'] = pd.concat([self.lx_table[MALE], self.lx_table[FEMALE]], axis=1,
+                                 keys=[MALE, FEMALE], names=['gender'])
+        sheets['hx'] = pd.concat([self.hx[MALE], self.hx[FEMALE]], axis=1,
+                                 keys=[MALE, FEMALE], names=['gender'])
+        sheets['adjustments'] = self.adjustments
+
+        write_sheets(sheets, filepath)
+        msg = "Ready. See {0} for output".format(filepath)
         print(msg)
@@ -0,0 +1,211 @@
+""" Valuation of portfolios of participants.
+
+A portfolio is a DataFrame with one row per participant and the columns
+of tbl_testdata: insurance_id, age, sex, pension_age and intrest.
+"""
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from factors.cache import read_arrays, write_arrays
+from factors.models import LifeTable
+from factors.writers import import_pyarrow
+
+COLUMNS = ['insurance_id', 'age', 'sex', 'pension_age', 'intrest']
+CHUNKS_PER_WORKER = 4
+BATCHSIZE = 10000  # max number of records of which cash flows are held at once
+
+# LifeTable of a worker process, see _init_worker
+_table = None
+
+
+def value_records(tab, df):
+    """ Returns Series with present value of each record (row) in df.
+
+    Records with equal insurance_id and intrest are valued together by
+    LifeTable.cf_array and LifeTable.pv_batch, in batches of at most
+    BATCHSIZE records.
+
+    Parameters:
+    -----------
+    tab: LifeTable
+    df: DataFrame with columns insurance_id, age, sex, pension_age and intrest
+    """
+    missing = [column for column in COLUMNS if column not in df.columns]
+    if missing:
+        raise ValueError("portfolio misses column(s): {}".format(", ".join(missing)))
+    out = np.full(len(df), np.nan)
+    keys = ['insurance_id', 'intrest']
+    groups = df[keys].reset_index(drop=True).groupby(keys, sort=False).indices
+    sexes, all_ages, pension_ages = (df[column].values for column in
+                                     ['sex', 'age', 'pension_age'])
+    for (insurance_id, intrest), group in groups.items():
+        for rows in np.array_split(group, int(np.ceil(len(group) / float(BATCHSIZE)))):
+            ages = all_ages[rows].astype(int)
+            pension_age = pension_ages[rows].astype(int)
+            nyears = tab.lx_array.shape[-1] + max(np.max(pension_age - ages), 0)
+            cfs = tab.cf_array(insurance_id, ages, sexes[rows], pension_age, nyears,
+                               intrest=intrest)
+            out[rows] = tab.pv_batch(cfs, intrest, insurance_id, ages, pension_age)
+    return pd.Series(out, index=df.index, name='factor')
+
+
+def _init_worker(tablename, calc_year, params, adjust, ukv, filepath):
+    global _table
+    arrays = read_arrays(filepath)[1]
+    _table = LifeTable.from_arrays(tablename, params, adjust,
+                                   lx_array=arrays['lx'], hx_array=arrays['hx'],
+                                   ukv=ukv, calc_year=calc_year)
+
+
+def _value_chunk(df):
+    return value_records(_table, df).values
+
+
+def _survival_filepath(tab):
+    """ Returns path of the file of which the lx and hx arrays of tab are memory mapped,
+    None if they are not memory mapped (from the same file).
+    """
+    filepaths = set(getattr(array, 'filename', None) for array in (tab.lx_array, tab.hx_array))
+    filepath = filepaths.pop()
+    return filepath if not filepaths and filepath is not None else None
+
+
+@contextmanager
+def worker_pool(tab, workers):
+    """ Returns process pool of which the workers share the lx and hx arrays of tab.
+
+    The workers memory map the file of LifeTable.get_survival_arrays, so they
+    share one copy of the arrays through the page cache. Arrays which are not
+    memory mapped are written to a temporary file first.
+
+    Parameters:
+    -----------
+    tab: LifeTable
+    workers: int
+    """
+    filepath = _survival_filepath(tab)
+    temp_filepath = None
+    try:
+        if filepath is None:
+            fd, temp_filepath = tempfile.mkstemp(suffix='.lxhx')
+            os.close(fd)
+            write_arrays(temp_filepath, OrderedDict([('lx', tab.lx_array),
+                                                     ('hx', tab.hx_array)]))
+            filepath = temp_filepath
+        initargs = (tab.tablename, tab.calc_year, tab.params, tab.adjust, tab.ukv, filepath)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=initargs) as pool:
+            yield pool
+    finally:
+        if temp_filepath is not None:
+            os.remove(temp_filepath)
+
+
+def _split(df, nchunks):
+    return [df.iloc[rows] for rows in np.array_split(np.arange(len(df)), nchunks)
+            if len(rows)]
+
+
+def value_portfolio(tab, df, workers=None, chunksize=None):
+    """ Returns Series with present value of each participant in df.
+
+    The records are split in chunks which are valued by a pool of worker
+    processes. The workers memory map the lx and hx arrays, see worker_pool.
+    The result has the same index (and order) as df.
+
+    Parameters:
+    -----------
+    tab: LifeTable
+    df: DataFrame with columns insurance_id, age, sex, pension_age and intrest
+    workers: int. Default os.cpu_count(). With 1 worker df is valued in-process.
+    chunksize: int, number of records per chunk. Default spreads df evenly
+    over CHUNKS_PER_WORKER chunks per worker.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(df) == 0:
+        return value_records(tab, df)
+    nchunks = (max(1, int(np.ceil(len(df) / float(chunksize)))) if chunksize
+               else workers * CHUNKS_PER_WORKER)
+    with worker_pool(tab, workers) as pool:
+        results = list(pool.map(_value_chunk, _split(df, nchunks)))
+    return pd.Series(np.concatenate(results), index=df.index, name='factor')
+
+
+def _file_format(filepath):
+    extension = os.path.splitext(filepath)[1].lower()
+    if extension not in ('.csv', '.parquet'):
+        raise ValueError("Unsupported file type {0}, use .csv or .parquet".format(filepath))
+    return extension[1:]
+
+
+def read_chunks(filepath, chunksize=100000):
+    """ Yields DataFrames with (at most) chunksize records of given csv or parquet file.
+    """
+    if _file_format(filepath) == 'csv':
+        for chunk in pd.read_csv(filepath, chunksize=chunksize):
+            yield chunk
+    else:
+        pyarrow = import_pyarrow()
+        parquet_file = pyarrow.parquet.ParquetFile(filepath)
+        for batch in parquet_file.iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+
+
+def value_file(tab, source, destination, chunksize=100000, workers=1):
+    """ Values participants of source file and writes them with their factor to destination.
+
+    Records are read, valued and written chunk by chunk, so memory use does
+    not depend on the size of the file.
+
+    Parameters:
+    -----------
+    tab: LifeTable
+    source: str, csv or parquet file with columns insurance_id, age, sex,
+    pension_age and intrest
+    destination: str, csv or parquet file
+    chunksize: int, number of records per chunk. Default 100000.
+    workers: int, number of worker processes. Default 1 (in-process),
+    None for os.cpu_count().
+    """
+    output_format = _file_format(destination)
+    workers = workers or os.cpu_count() or 1
+    nrecords = 0
+    writer = None
+    with _pool_or_none(tab, workers) as pool:
+        try:
+            for chunk in read_chunks(source, chunksize):
+                if pool is None:
+                    chunk['factor'] = value_records(tab, chunk).values
+                else:
+                    chunks = _split(chunk, workers * CHUNKS_PER_WORKER)
+                    chunk['factor'] = np.concatenate(list(pool.map(_value_chunk, chunks)))
+                if output_format == 'csv':
+                    chunk.to_csv(destination, mode='w' if nrecords == 0 else 'a',
+                                 header=nrecords == 0, index=False)
+                else:
+                    pyarrow = import_pyarrow()
+                    table = pyarrow.Table.from_pandas(chunk, preserve_index=False)
+                    if writer is None:
+                        writer = pyarrow.parquet.ParquetWriter(destination, table.schema)
+                    writer.write_table(table)
+                nrecords += len(chunk)
+        finally:
+            if writer is not None:
+                writer.close()
+    print("Ready. Valued {0} records, see {1} for output".format(nrecords, destination))
+    return nrecords
+
+
+@contextmanager
+def _pool_or_none(tab, workers):
+    if workers > 1:
+        with worker_pool(tab, workers) as pool:
+            yield pool
+    else:
+        yield None
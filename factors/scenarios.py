@@ -0,0 +1,130 @@
+""" Valuation of the factor grid under many yield curve scenarios.
+
+The cash flows of all insurance_ids, sexes and ages are generated once and
+discounted against a matrix of yield curves (n_scenarios x n_years).
+
+Only the undefined partner pensions (NPLL-O, NPLLRS) depend on intrest:
+before pension age they pay the single premium of a partner annuity
+(ay_avg, see LifeTable.create_lookup_table). Their cash flows are therefore
+split into a part that does not depend on intrest and weights for ay_avg,
+which is calculated per scenario.
+"""
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from factors import kernels
+from factors.settings import (LOWAGE, UPAGE, GENDERS, INSURANCE_IDS,
+                              UNDEFINED_PARTNER_IDS)
+from factors.utils import x_to_matrix, half_year_mask
+
+CHUNKSIZE = 500  # number of scenarios discounted at once
+
+
+def split_cashflows(tab, pension_age, insurance_ids=INSURANCE_IDS):
+    """ Returns cash flows of cashflow_cube split in a part that does not depend on intrest
+    and the weights of ay_avg of the undefined partner pensions, see
+    LifeTable.cashflow_parts.
+
+    Returns dict with:
+    cube: array (insurance_id, sex, age, year), cash flows without the ay_avg part
+    labels: OrderedDict, labels of the axes of cube
+    weights, age_in_year: arrays (sex, age, year), the cash flow of the undefined
+    partner pensions in year t is ay_avg[sex, age_in_year] * weights plus cube
+    undefined: array of bool (insurance_id), True for undefined partner pensions
+
+    Parameters:
+    -----------
+    tab: LifeTable
+    pension_age: int
+    insurance_ids: list of str. Default all INSURANCE_IDS.
+    """
+    parts = [tab.cashflow_parts(insurance_id, pension_age) for insurance_id in insurance_ids]
+    cube = np.stack([x['fixed'] for x in parts])
+    undefined = np.array([x in UNDEFINED_PARTNER_IDS for x in insurance_ids])
+    out = {'cube': cube, 'undefined': undefined}
+    if undefined.any():
+        out['weights'] = parts[undefined.argmax()]['weights']
+        out['age_in_year'] = parts[undefined.argmax()]['age_in_year']
+    out['labels'] = OrderedDict([('insurance_id', list(insurance_ids)),
+                                 ('sex_insured', list(GENDERS)),
+                                 ('age_insured', np.arange(LOWAGE, UPAGE)),
+                                 ('year', np.arange(cube.shape[-1]))])
+    return out
+
+
+def ay_avg_matrix(tab, rates):
+    """ Returns ay_avg (see LifeTable.ay_avg) array (scenario, sex, age) for each
+    row of rates (scenario, year). Ages outside LOWAGE..UPAGE - 1 are zero.
+    """
+    nyears = tab.lx_array.shape[-1]
+    ages = np.arange(LOWAGE, UPAGE)
+    cfs = np.stack([kernels.cf_ay_avg(tab, ages, gender, nyears)
+                    for gender in range(len(GENDERS))])
+    v = (1. / (1 + rates[:, :nyears] / 100.)) ** np.arange(nyears)
+    out = np.zeros((len(rates), len(GENDERS), nyears))
+    out[:, :, ages] = np.einsum('gat,st->sga', cfs, v)
+    return out
+
+
+def _value_chunk(tab, parts, rates, pension_age):
+    cube, labels = parts['cube'], parts['labels']
+    nyears = cube.shape[-1]
+    year = np.arange(nyears)
+    v = 1. / (1 + rates / 100.)
+    discount = np.concatenate([v ** year, v ** (year + 0.5)], axis=1)
+    insurance_ids = np.array(labels['insurance_id'])[:, None, None]
+    mid_year = half_year_mask(insurance_ids, labels['age_insured'][None, None, :],
+                              pension_age, nyears)
+    weighted = np.concatenate([np.where(mid_year, 0., cube),
+                               np.where(mid_year, cube, 0.)], axis=-1)
+    out = discount.dot(weighted.reshape(-1, 2 * nyears).T)
+    out = out.reshape((len(rates),) + cube.shape[:-1])
+
+    if parts['undefined'].any():
+        # years till pension age are paid in the middle of the year
+        nyears_till_pension_age = max(pension_age - LOWAGE, 0)
+        ay_avg = ay_avg_matrix(tab, rates)
+        weights = parts['weights'][..., :nyears_till_pension_age]
+        age_in_year = parts['age_in_year'][..., :nyears_till_pension_age]
+        v_half = discount[:, nyears:nyears + nyears_till_pension_age]
+        for gender in range(len(GENDERS)):
+            pv = np.einsum('sat,at,st->sa', ay_avg[:, gender][:, age_in_year[gender]],
+                           weights[gender], v_half)
+            out[:, parts['undefined'], gender] += pv[:, None, :]
+    return out
+
+
+def scenario_factors(tab, curves, pension_age=67, insurance_ids=INSURANCE_IDS,
+                     chunksize=CHUNKSIZE):
+    """ Returns factors of all insurance_ids, sexes and ages for each yield curve.
+
+    The cash flows are generated once, the scenarios are discounted in chunks
+    of chunksize scenarios to bound memory use.
+
+    Parameters:
+    -----------
+    tab: LifeTable
+    curves: 2-D array or DataFrame (n_scenarios, n_years) with intrest in pct,
+    curves are padded with their last rate. A single curve (int, float, list or
+    Series) is treated as one scenario.
+    pension_age: int. Default 67.
+    insurance_ids: list of str. Default all INSURANCE_IDS.
+    chunksize: int, number of scenarios discounted at once. Default CHUNKSIZE.
+
+    Returns (array (scenario, insurance_id, sex, age), OrderedDict with the labels
+    of the axes). Use utils.array_to_table for a (long) factor table.
+    """
+    parts = split_cashflows(tab, pension_age, insurance_ids)
+    nyears = parts['cube'].shape[-1]
+    rates = x_to_matrix(curves, nyears)
+    out = np.empty((len(rates),) + parts['cube'].shape[:-1])
+    for start in range(0, len(rates), chunksize):
+        out[start:start + chunksize] = _value_chunk(tab, parts, rates[start:start + chunksize],
+                                                    pension_age)
+    scenarios = (curves.index.values if isinstance(curves, pd.DataFrame)
+                 else np.arange(len(rates)))
+    labels = OrderedDict([('scenario', scenarios)])
+    labels.update(list(parts['labels'].items())[:3])
+    return out, labels
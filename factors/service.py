@@ -0,0 +1,315 @@
+""" Asynchronous HTTP/JSON service for valuing participants.
+
+Start with:
+
+    python -m factors.service --table AG2022 --calc-year 2022 --port 8080
+
+and value a participant (or a list of participants) with a POST request:
+
+    curl -d '{"insurance_id": "OPLL", "age": 40, "sex": "M",
+              "pension_age": 68, "intrest": 2}' localhost:8080/value
+
+The tables are read once at start up. Concurrent requests are collected
+for at most max_latency seconds and then valued together as one batch by
+portfolio.value_records, so the vectorized cash flow kernels do the work
+for many requests at once.
+"""
+import argparse
+import asyncio
+import math
+from concurrent.futures import ThreadPoolExecutor
+import json
+import numbers
+
+import numpy as np
+import pandas as pd
+
+from factors.models import LifeTable
+from factors.portfolio import COLUMNS, BATCHSIZE, value_records
+from factors.settings import GENDERS, INSURANCE_IDS, UNDEFINED_PARTNER_IDS
+
+MAX_LATENCY = 0.005  # seconds a request may wait for other requests to join its batch
+MAX_BODY_SIZE = 64 * 1024 * 1024
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 413: 'Payload Too Large',
+           500: 'Internal Server Error'}
+
+
+def age_limits(tab, insurance_id, sex):
+    """ Returns ((min, max) age, (min, max) pension_age) of records of insurance_id and sex
+    tab can value.
+
+    The ages, shifted by the adjustments CX1 and CX2 of the insured and by delta and CX3
+    of the beneficiary, should be within the lx array.
+    NPLL-O needs hx at pension age, NPTL-O needs hx at age and age + 1.
+    """
+    maxage = tab.lx_array.shape[-1] - 1
+    maxage_hx = tab.hx_array.shape[-1] - 1
+    if insurance_id == 'OPLL':
+        retire = tab.adjust[sex]['retire']
+        minage = max(0, *[int(math.ceil(-retire[item])) for item in ['CX1', 'CX2']])
+        return (minage, maxage), (minage, maxage)
+    partner = tab.adjust[sex]['partner']
+    sex_beneficiary = GENDERS[1 - GENDERS.index(sex)]
+    sign = 1 if sex == GENDERS[0] else -1
+    age_beneficiary = (sign * int(tab.params['delta']) -
+                       tab.adjust[sex_beneficiary]['partner']['CX3'])
+    minage = max(0, *[int(math.ceil(value)) for value in
+                      [age_beneficiary, -partner['CX1'], -partner['CX2']]])
+    shift = max(int(math.ceil(partner['CX1'])), 0)
+    if insurance_id == 'NPLL-B':
+        return (minage, maxage - shift), (minage, maxage - shift)
+    if insurance_id == 'NPLL-O':
+        return (minage, maxage), (minage, min(maxage - shift, maxage_hx))
+    if insurance_id in UNDEFINED_PARTNER_IDS:
+        return (minage, maxage), (minage, maxage - shift)
+    if insurance_id == 'NPTL-O':
+        return (minage, maxage_hx - 1), (0, maxage)
+    return (minage, maxage), (0, maxage)
+
+
+def check_record(record, tab):
+    """ Returns record (dict) with the COLUMNS needed for valuation, raises ValueError if invalid.
+
+    Parameters:
+    -----------
+    record: dict
+    tab: LifeTable the record is valued with, see age_limits
+    """
+    if not isinstance(record, dict):
+        raise ValueError("record should be a JSON object, got {}".format(record))
+    missing = [column for column in COLUMNS if column not in record]
+    if missing:
+        raise ValueError("record misses field(s): {}".format(", ".join(missing)))
+    if record['insurance_id'] not in INSURANCE_IDS:
+        raise ValueError("Unknown insurance_id {}".format(record['insurance_id']))
+    if record['sex'] not in GENDERS:
+        raise ValueError("sex should be either {0} or {1}".format(*GENDERS))
+    limits = age_limits(tab, record['insurance_id'], record['sex'])
+    for column, (minage, maxage) in zip(['age', 'pension_age'], limits):
+        value = record[column]
+        if (not isinstance(value, numbers.Integral) or isinstance(value, bool) or
+                not minage <= value <= maxage):
+            raise ValueError("{0} of {1} should be an integer between {2} and {3}".format(
+                column, record['insurance_id'], minage, maxage))
+    if not isinstance(record['intrest'], numbers.Real) or isinstance(record['intrest'], bool):
+        raise ValueError("intrest should be a number")
+    return {column: record[column] for column in COLUMNS}
+
+
+class Batcher(object):
+    """ Collects records of concurrent requests and values them in batches.
+
+    A batch is valued when max_latency seconds have passed since its first
+    record arrived or when it holds max_batchsize records.
+
+    Parameters:
+    -----------
+    tab: LifeTable
+    max_latency: float, seconds. Default MAX_LATENCY.
+    max_batchsize: int, number of records. Default portfolio.BATCHSIZE.
+    executor: Executor in which batches are valued. Default one thread.
+    """
+
+    def __init__(self, tab, max_latency=MAX_LATENCY, max_batchsize=BATCHSIZE,
+                 executor=None):
+        self.tab = tab
+        self.max_latency = max_latency
+        self.max_batchsize = max_batchsize
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+        self.nbatches = 0
+        self.nrecords = 0
+        self._pending = []
+        self._npending = 0
+        self._timer = None
+
+    async def value(self, records):
+        """ Returns list with the factor of each (checked) record.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((records, future))
+        self._npending += len(records)
+        if self._npending >= self.max_batchsize:
+            self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_latency, self.flush)
+        return await future
+
+    def flush(self):
+        """ Starts valuation of the pending records.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending, self._npending = self._pending, [], 0
+        if batch:
+            asyncio.ensure_future(self._value_batch(batch))
+
+    async def _value_batch(self, batch):
+        df = pd.DataFrame([record for records, _ in batch for record in records],
+                          columns=COLUMNS)
+        loop = asyncio.get_running_loop()
+        try:
+            values = await loop.run_in_executor(self.executor, value_records, self.tab, df)
+        except Exception as e:
+            if len(batch) == 1:
+                if not batch[0][1].done():
+                    batch[0][1].set_exception(e)
+            else:
+                # value the requests one by one, so only the failing ones get the error
+                for item in batch:
+                    await self._value_batch([item])
+            return
+        self.nbatches += 1
+        self.nrecords += len(df)
+        values = values.tolist()
+        start = 0
+        for records, future in batch:
+            if not future.done():
+                future.set_result(values[start:start + len(records)])
+            start += len(records)
+
+
+class FactorService(object):
+    """ Values records against a number of LifeTables.
+
+    Parameters:
+    -----------
+    tablenames: list of str
+    calc_year: int
+    max_latency: float, seconds. Default MAX_LATENCY.
+    max_batchsize: int. Default portfolio.BATCHSIZE.
+    workers: int, number of threads valuing batches. Default 1.
+    """
+
+    def __init__(self, tablenames, calc_year=2017, max_latency=MAX_LATENCY,
+                 max_batchsize=BATCHSIZE, workers=1):
+        if not tablenames:
+            raise ValueError("FactorService requires at least one table")
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.batchers = {tablename: Batcher(LifeTable.get(tablename, calc_year=calc_year),
+                                            max_latency, max_batchsize, self.executor)
+                         for tablename in tablenames}
+        self.default_table = tablenames[0] if len(tablenames) == 1 else None
+
+    def get_batcher(self, record):
+        tablename = record.get('table', self.default_table) if isinstance(record, dict) else None
+        if tablename not in self.batchers:
+            raise ValueError("record should have field table, one of {}".format(
+                ", ".join(sorted(self.batchers))))
+        return self.batchers[tablename]
+
+    async def value(self, records):
+        """ Returns list with factor of each record (dict).
+        """
+        groups = {}
+        for i, record in enumerate(records):
+            batcher = self.get_batcher(record)
+            groups.setdefault(batcher, ([], []))
+            groups[batcher][0].append(i)
+            groups[batcher][1].append(check_record(record, batcher.tab))
+        out = [None] * len(records)
+        results = await asyncio.gather(*[batcher.value(group)
+                                         for batcher, (_, group) in groups.items()])
+        for (indices, _), values in zip(groups.values(), results):
+            for i, value in zip(indices, values):
+                out[i] = None if np.isnan(value) else value
+        return out
+
+    async def handle_request(self, method, path, body):
+        """ Returns (status, response) for given HTTP request.
+        """
+        if path == '/health':
+            return 200, {'status': 'ok', 'tables': sorted(self.batchers)}
+        if path != '/value':
+            return 404, {'error': "Unknown path {}".format(path)}
+        if method != 'POST':
+            return 405, {'error': "Use POST to value records"}
+        try:
+            payload = json.loads(body.decode('utf-8'))
+            if isinstance(payload, list):
+                return 200, {'factors': await self.value(payload)}
+            return 200, {'factor': (await self.value([payload]))[0]}
+        except ValueError as e:
+            return 400, {'error': str(e)}
+        except Exception as e:
+            return 500, {'error': "{0}: {1}".format(type(e).__name__, e)}
+
+    async def handle_connection(self, reader, writer):
+        """ Serves HTTP/1.1 requests of one connection (keep-alive supported).
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY_SIZE:
+                    status, response = 413, {'error': "Request body too large"}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length)
+                    status, response = await self.handle_request(method, path.split('?')[0], body)
+                    keep_alive = (version == 'HTTP/1.1' and
+                                  headers.get('connection', '').lower() != 'close')
+                content = json.dumps(response).encode('utf-8')
+                head = ("HTTP/1.1 {0} {1}\r\nContent-Type: application/json\r\n"
+                        "Content-Length: {2}\r\nConnection: {3}\r\n\r\n").format(
+                    status, REASONS[status], len(content), 'keep-alive' if keep_alive else 'close')
+                writer.write(head.encode('latin-1') + content)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ValueError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8080):
+        """ Returns asyncio Server listening on given host and port.
+        """
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+
+async def serve(service, host='127.0.0.1', port=8080):
+    server = await service.start(host, port)
+    print("Serving {0} on {1}".format(", ".join(sorted(service.batchers)),
+                                      ", ".join(str(s.getsockname()) for s in server.sockets)))
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="HTTP/JSON service for actuarial factors")
+    parser.add_argument('--table', action='append', required=True,
+                        help="name of table to serve, can be repeated")
+    parser.add_argument('--calc-year', type=int, default=2017)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-latency', type=float, default=MAX_LATENCY * 1000.,
+                        help="max time (ms) a request waits to be batched. Default 5.")
+    parser.add_argument('--max-batchsize', type=int, default=BATCHSIZE)
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of threads valuing batches. Default 1.")
+    args = parser.parse_args(argv)
+    service = FactorService(args.table, calc_year=args.calc_year,
+                            max_latency=args.max_latency / 1000.,
+                            max_batchsize=args.max_batchsize, workers=args.workers)
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
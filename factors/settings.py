@@ -2,6 +2,7 @@ import os
 
 MALE = 'M'
 FEMALE = 'F'
+GENDERS = (MALE, FEMALE)  # order of the gender axis in the lx/hx arrays
 
 LOWAGE = 15
 UPAGE = 70
@@ -11,3 +12,10 @@ DATADIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'data')
 
 INSURANCE_IDS = ['OPLL', 'NPLL-B', 'NPLL-O',
                  'NPLLRS', 'NPTL-B', 'NPTL-O', 'ay_avg']
+
+# undefined partner pensions, the only cash flows depending on intrest (through ay_avg)
+UNDEFINED_PARTNER_IDS = ['NPLL-O', 'NPLLRS', 'NPLLRU']
+
+# compiled workbooks and other cached artifacts are stored here
+CACHEDIR = os.environ.get('FACTORS_CACHE_DIR',
+                          os.path.join(os.path.expanduser('~'), '.cache', 'factors'))
@@ -21,9 +21,9 @@ def guaranteed_temp_folder_for_each_test():
 
 @pytest.fixture(scope="session")
 def aegon_table():
-    return LifeTable("AEG2011")
+    return LifeTable.get("AEG2011")
 
 
 @pytest.fixture(scope="session")
 def ag_table():
-    return LifeTable("AG2014")
+    return LifeTable.get("AG2014")
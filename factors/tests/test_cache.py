@@ -0,0 +1,205 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from factors import cache, LifeTable
+from factors.settings import INSURANCE_IDS
+from factors.utils import get_excel_filepath
+
+
+def test_compiled_workbook_is_rebuilt_when_hash_changes(tmpdir, monkeypatch):
+    monkeypatch.setattr(cache, 'CACHEDIR', str(tmpdir))
+    monkeypatch.setattr(cache, '_workbooks', {})
+    xlswb = str(tmpdir.join('AEG2011.xlsx'))
+    shutil.copy(get_excel_filepath('AEG2011'), xlswb)
+
+    sheets = cache.load_workbook(xlswb)
+    compiled_filepath = cache.get_compiled_filepath(xlswb)
+    assert os.path.isfile(compiled_filepath)
+    assert 'tbl_lx' in sheets
+
+    # another version of the workbook gets its own artifact
+    sheets['tbl_lx'].loc[0, 'lx'] += 1
+    with pd.ExcelWriter(xlswb) as writer:
+        for sheet_name, df in sheets.items():
+            df.to_excel(writer, sheet_name=sheet_name, index=False)
+    assert cache.get_compiled_filepath(xlswb) != compiled_filepath
+
+    changed = cache.load_workbook(xlswb)
+    assert os.path.isfile(cache.get_compiled_filepath(xlswb))
+    sha, compiled = cache.read_sheets(cache.get_compiled_filepath(xlswb))
+    assert sha == cache.file_hash(xlswb)
+    assert changed['tbl_lx'].equals(sheets['tbl_lx'])
+    assert compiled['tbl_lx'].equals(sheets['tbl_lx'])
+
+
+def test_compiled_workbook_round_trip(tmpdir):
+    # generation table with int (year) column names, sheets with mixed type columns
+    for name in ['AG2014', 'GB1015WO']:
+        sheets = pd.read_excel(get_excel_filepath(name), sheet_name=None)
+        filepath = str(tmpdir.join(name + cache.COMPILED_EXTENSION))
+        cache.write_sheets(filepath, sheets, 'sha')
+        sha, compiled = cache.read_sheets(filepath)
+        assert sha == 'sha' and list(compiled) == list(sheets)
+        for sheet_name, df in sheets.items():
+            assert compiled[sheet_name].equals(df)
+            assert list(compiled[sheet_name].columns) == list(df.columns)
+            assert (compiled[sheet_name].dtypes == df.dtypes).all()
+
+
+def test_unreadable_compiled_workbook_is_rebuilt(tmpdir, monkeypatch):
+    monkeypatch.setattr(cache, 'CACHEDIR', str(tmpdir))
+    monkeypatch.setattr(cache, '_workbooks', {})
+    xlswb = str(tmpdir.join('AEG2011.xlsx'))
+    shutil.copy(get_excel_filepath('AEG2011'), xlswb)
+    compiled_filepath = cache.get_compiled_filepath(xlswb)
+    with open(compiled_filepath, 'wb') as f:
+        f.write(b'not an artifact')
+
+    sheets = cache.load_workbook(xlswb)
+    assert 'tbl_lx' in sheets
+    assert cache.read_sheets(compiled_filepath)[1]['tbl_lx'].equals(sheets['tbl_lx'])
+
+
+def test_read_sheet_returns_copy():
+    xlswb = get_excel_filepath('AEG2011')
+    df = cache.read_sheet(xlswb, 'tbl_lx')
+    df.set_index(['gender', 'age'], inplace=True)
+    assert 'gender' in cache.read_sheet(xlswb, 'tbl_lx').columns
+
+
+def test_lru_cache_evicts_least_recently_used():
+    lru = cache.LRUCache(maxsize=2)
+    lru.put('a', 1)
+    lru.put('b', 2)
+    assert lru.get('a') == 1
+    lru.put('c', 3)
+    assert 'b' not in lru
+    assert lru.get('b') is None
+    assert lru.info() == cache.CacheInfo(hits=1, misses=1, maxsize=2, currsize=2)
+
+
+def test_discount_factors_are_shared(aegon_table):
+    cache.DISCOUNT_FACTORS.clear()
+    curve = pd.Series([1., 1.5, 2.])
+    first = cache.discount_factors(curve, 5)
+    assert cache.discount_factors(list(curve), 5) is first
+    assert first == pytest.approx([1, 1 / 1.015, 1 / 1.02 ** 2, 1 / 1.02 ** 3, 1 / 1.02 ** 4])
+    assert cache.discount_factors(3, 5, 0.5) is not cache.discount_factors(3, 5)
+
+    aegon_table.ay_avg(60, 'M', 3)
+    aegon_table.ay_avg(61, 'M', 3)
+    info = cache.DISCOUNT_FACTORS.info()
+    assert info.misses == 4
+    assert info.hits == 2
+
+
+def test_lru_cache_memory_accounting():
+    lru = cache.LRUCache(maxsize=10, maxbytes=2000)
+    lru.put('a', {'x': np.zeros(100)})
+    lru.put('b', np.zeros(100))
+    assert lru.nbytes == 1600
+    lru.put('c', np.zeros(100))
+    assert 'a' not in lru and lru.nbytes == 1600
+    assert lru.invalidate(lambda key: key == 'b') == 1
+    assert lru.nbytes == 800
+
+
+def test_cashflow_parts_are_cached(aegon_table):
+    aegon_table.invalidate_cashflows()
+    parts = aegon_table.cashflow_parts('NPLL-O', 67)
+    assert aegon_table.cashflow_parts('NPLL-O', 67) is parts
+    assert not parts['fixed'].flags.writeable
+    aegon_table.cashflow_cube(67, 2)
+    assert aegon_table.invalidate_cashflows(pension_age=67) == len(INSURANCE_IDS)
+    assert aegon_table.cashflow_parts('NPLL-O', 67) is not parts
+
+
+def test_cashflow_parts_of_shocked_table(aegon_table):
+    aegon_table.cashflow_cube(67, 3)
+    lx_array = aegon_table.lx_array.copy()
+    lx_array[:, 41:] *= 0.9 ** np.arange(1, lx_array.shape[-1] - 40)
+    shocked = LifeTable.from_arrays('AEG2011', aegon_table.params, aegon_table.adjust,
+                                    lx_array, aegon_table.hx_array)
+    assert shocked.cache_key() != aegon_table.cache_key()
+    cube, labels = shocked.cashflow_cube(67, 3)
+    factors = shocked.cube_factors(cube, labels, 3, 67)
+    i, age = labels['insurance_id'].index('OPLL'), 40
+    cf = shocked.cf('OPLL', age, 'M', 67)
+    expected = shocked.pv(cf, 3)
+    assert expected != pytest.approx(aegon_table.pv(aegon_table.cf('OPLL', age, 'M', 67), 3))
+    assert factors[i, 0, list(labels['age_insured']).index(age)] == pytest.approx(expected)
+
+
+def test_disk_cache(tmpdir):
+    disk_cache = cache.DiskCache(str(tmpdir), maxbytes=3000)
+    key = disk_cache.key('AEG2011', 67, 3.)
+    assert key == disk_cache.key('AEG2011', 67, 3.)
+    assert disk_cache.get(key) is None
+    disk_cache.put(key, {'x': np.arange(100.)})
+    cached = disk_cache.get(key)
+    assert isinstance(cached['x'], np.memmap) and cached['x'][99] == 99.
+    # exceeding maxbytes evicts the least recently used entry
+    os.utime(disk_cache.get_path(key), (0, 0))
+    other = disk_cache.key('AEG2011', 67, 2.)
+    disk_cache.put(other, {'x': np.arange(300.)})
+    assert disk_cache.get(key) is None
+    assert disk_cache.get(other) is not None
+
+
+def test_disk_cache_partial_entry_is_a_miss(tmpdir):
+    disk_cache = cache.DiskCache(str(tmpdir))
+    key = disk_cache.key('AEG2011', 67, 3.)
+    disk_cache.put(key, {'x': np.arange(10.), 'y': np.arange(5.)})
+    # entry being removed by another process
+    os.remove(os.path.join(disk_cache.get_path(key), 'y.npy'))
+    assert disk_cache.get(key) is None
+    os.remove(os.path.join(disk_cache.get_path(key), disk_cache.MANIFEST))
+    assert disk_cache.get(key) is None
+
+
+def test_factors_from_disk_cache(tmpdir, aegon_table):
+    tab = LifeTable.get("AEG2011", disk_cache=cache.DiskCache(str(tmpdir)))
+    expected = tab.calculate_factors(intrest=2.5, pension_age=65)
+    cube, _ = tab.cashflow_cube(65, 2.5)
+    other = LifeTable.get("AEG2011", disk_cache=cache.DiskCache(str(tmpdir)))
+    pd.testing.assert_frame_equal(other.calculate_factors(intrest=2.5, pension_age=65), expected)
+    assert other.cfs is None
+    cached_cube, _ = other.cashflow_cube(65, 2.5)
+    assert isinstance(cached_cube, np.memmap)
+    np.testing.assert_array_equal(cached_cube, cube)
+
+
+def test_write_and_read_arrays(tmpdir, monkeypatch):
+    filepath = str(tmpdir.join('arrays.lxhx'))
+    lx = np.random.default_rng(0).random((2, 121, 121))
+    hx = np.arange(10.).reshape(2, 5)
+    cache.write_arrays(filepath, {'lx': lx, 'hx': hx}, meta={'sha256': 'abc'})
+    meta, arrays = cache.read_arrays(filepath)
+    assert meta == {'sha256': 'abc'}
+    assert isinstance(arrays['lx'], np.memmap) and not arrays['lx'].flags.writeable
+    np.testing.assert_array_equal(arrays['lx'], lx)
+    np.testing.assert_array_equal(arrays['hx'], hx)
+    monkeypatch.setattr(cache, 'ARRAYS_VERSION', cache.ARRAYS_VERSION + 1)
+    with pytest.raises(ValueError):
+        cache.read_arrays(filepath)
+
+
+def test_survival_arrays_are_memory_mapped(ag_table):
+    tab = LifeTable("AG2014")
+    assert isinstance(tab.lx_array, np.memmap)
+    assert tab.lx_array.filename == os.path.abspath(tab.get_survival_filepath())
+    assert 'generation_table' not in vars(tab)  # not rebuilt
+    np.testing.assert_array_equal(tab.lx_array, ag_table.lx_array)
+
+
+def test_survival_arrays_are_rebuilt_for_new_version(ag_table, monkeypatch):
+    from factors import models
+    monkeypatch.setattr(models, 'SURVIVAL_VERSION', models.SURVIVAL_VERSION + 1)
+    tab = LifeTable("AG2014")
+    assert 'qx_array' in vars(tab)  # rebuilt
+    assert cache.read_arrays(tab.get_survival_filepath())[0]['version'] == models.SURVIVAL_VERSION
+    np.testing.assert_array_equal(tab.lx_array, ag_table.lx_array)
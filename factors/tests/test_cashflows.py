@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from factors import cashflows
+from factors.cashflows import CashFlow
+from factors.settings import UNDEFINED_PARTNER_IDS
+
+
+def test_cashflow_from_array():
+    array = np.array([0., 0., 1., 0., 2., 0., 0.])
+    cf = CashFlow.from_array(array)
+    assert (cf.start, cf.stop, len(cf)) == (2, 5, 7)
+    assert list(cf.values) == [1., 0., 2.]
+    assert np.array_equal(cf.to_array(), array)
+    assert cf.to_array(3).tolist() == [0., 0., 1.]
+    assert cf.dot(np.arange(7)) == 2 + 8
+    assert cf == CashFlow([1., 0., 2.], 2, 7)
+    empty = CashFlow.from_array(np.zeros(4))
+    assert len(empty.values) == 0 and empty.dot(np.ones(4)) == 0
+    with pytest.raises(ValueError):
+        CashFlow([1., 2.], 3, 4)
+
+
+@pytest.mark.parametrize("table", ['aegon_table', 'ag_table'])
+def test_pv_batch_sparse(table, request):
+    tab = request.getfixturevalue(table)
+    cube, labels = tab.cashflow_cube(67, 3)
+    insurance_ids = np.array(labels['insurance_id'])[:, None, None]
+    ages = np.asarray(labels['age_insured'])[None, None, :]
+    sparse = cashflows.from_array(cube)
+    assert sum(x.nbytes for x in sparse.flat) < cube.nbytes
+    curves = np.array([[3.], [2.]]) + np.linspace(0, 1, 30)
+    expected = tab.pv_batch(cube, curves, insurance_ids, ages, 67)
+    calculated = tab.pv_batch(sparse, curves, insurance_ids, ages, 67)
+    assert calculated == pytest.approx(expected, rel=1e-12, abs=1e-12)
+
+
+def test_get_cashflows_sparse(aegon_table):
+    df = aegon_table.get_cashflows(67, 3, sparse=True)
+    assert all(isinstance(cf['payments'], CashFlow) for cf in df['cf'])
+    dense = aegon_table.get_cashflows(67, 3)
+    for i in [0, 300, 500]:
+        cf, expected = df['cf'].iloc[i], dense['cf'].iloc[i]
+        assert isinstance(expected['payments'], pd.Series)
+        assert np.array_equal(cf['payments'].to_array(len(expected['payments'])),
+                              expected['payments'].values)
+        assert aegon_table.pv(cf, 3) == pytest.approx(aegon_table.pv(expected, 3))
+
+    recalculated = aegon_table.get_cashflows(67, 2, cfs=df, sparse=True)
+    undefined = df['insurance_id'].isin(UNDEFINED_PARTNER_IDS).values
+    assert all(x is y for x, y in zip(df['cf'][~undefined], recalculated['cf'][~undefined]))
+    assert not any(x is y for x, y in zip(df['cf'][undefined], recalculated['cf'][undefined]))
+
+
+def test_cashflow_table_sparse(ag_table):
+    dense = ag_table.cashflow_table(67, 3)
+    sparse = ag_table.cashflow_table(67, 3, sparse=True)
+    assert len(sparse) < len(dense)
+    assert list(sparse.columns) == list(dense.columns)
+    keys = ['insurance_id', 'sex', 'age', 'year']
+    merged = dense.merge(sparse, on=keys, how='left', suffixes=('', '_sparse'))
+    assert len(merged) == len(dense)
+    assert np.allclose(merged['payment_sparse'].fillna(0.), merged['payment'].fillna(0.))
+
+
+def test_calculate_cashflows_keeps_representation(aegon_table):
+    tab = aegon_table.view()
+    tab.calculate_cashflows(67, 3)
+    for sparse, kind in [(True, CashFlow), (False, pd.Series)]:
+        df = tab.calculate_cashflows(67, 2, sparse=sparse)
+        assert all(isinstance(cf['payments'], kind) for cf in df['cf'])
+    assert tab.get_cashflows(67, 3, sparse=True)['cf'].iloc[0]['payments'].to_series().equals(
+        tab.get_cashflows(67, 3)['cf'].iloc[0]['payments'])
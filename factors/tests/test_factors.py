@@ -1,5 +1,7 @@
 import os
 import numpy as np
+import pandas as pd
+import pytest
 
 
 def test_ag2014_data(ag_table):
@@ -22,7 +24,21 @@ def test_export(aegon_table):
     tables = aegon_table
     tables.export("text.xlsx", intrest=3, pension_age=67)
     assert os.path.exists("text.xlsx")
-    # TODO Load Excel sheet and check that it's correct
+    factors = pd.read_excel("text.xlsx", sheet_name='factors', header=[0, 1, 2], index_col=0)
+    expected = tables.get_factors(intrest=3, pension_age=67)['tar']
+    for (insurance_id, sex, age), value in expected.dropna().items():
+        assert factors[('tar', sex, insurance_id)][age] == pytest.approx(value)
+
+
+def test_export_csv(aegon_table):
+    aegon_table.export("text.csv", intrest=3, pension_age=67)
+    cashflows = pd.read_csv("text_cashflows.csv")
+    assert list(cashflows.columns) == ['insurance_id', 'sex', 'age', 'year', 'payment']
+    cf = aegon_table.cf('OPLL', 40, 'M', 67)['payments']
+    calculated = cashflows.query("insurance_id == 'OPLL' and sex == 'M' and age == 40")
+    nyears = min(len(cf), len(calculated))
+    assert calculated['payment'].values[:nyears] == pytest.approx(cf.values[:nyears])
+    assert not cf.values[nyears:].any()
 
 
 def test_single_person(aegon_table):
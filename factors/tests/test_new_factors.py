@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 import pytest
 from factors.models import LifeTable
@@ -59,6 +60,26 @@ def test_nqx(tablename, age, sex, nyears, test_value):
     assert (calculated == pytest.approx(test_value))
 
 
+# ------ test npx, qx and nqx on arrays -------------------------------
+@pytest.mark.parametrize("tablename", ["AEG2011", "AG2014"])
+def test_survival_arrays(tablename):
+    tab = my_lifetable(tablename)
+    ages = np.arange(15, 70)
+    sexes = np.where(ages % 2, MALE, FEMALE)
+    nyears = np.arange(len(ages)) % 40
+    expected_npx = [tab.npx(*args) for args in zip(ages, sexes, nyears)]
+    expected_qx = [tab.qx(*args) for args in zip(ages, sexes)]
+    expected_nqx = [tab.nqx(*args) for args in zip(ages, sexes, nyears + 1)]
+    assert tab.npx(ages, sexes, nyears) == pytest.approx(expected_npx)
+    assert tab.qx(ages, sexes) == pytest.approx(expected_qx)
+    assert tab.nqx(ages, sexes, nyears + 1) == pytest.approx(expected_nqx)
+    if tab.params['is_flat']:
+        lx = tab.lx_table[MALE]['lx']
+    else:
+        lx = tab.lx_table[MALE]['lx'].loc[25]
+    assert tab.npx(25, MALE, 40) == pytest.approx(lx.loc[65] / lx.loc[25])
+
+
 # ------ test cf_annuity ----------------------------------------------
 params = "tablename, age_insured, sex_insured, year_cf, test_value"
 
@@ -132,6 +153,16 @@ def test_create_lookup_table(tablename, intrest, sex_insured,
             pytest.approx(test_value))
 
 
+def test_get_lookup_table_caches_per_intrest():
+    tab = my_lifetable("AEG2011")
+    lookup_3pct = tab.get_lookup_table(3)
+    lookup_curve = tab.get_lookup_table([1., 2.])
+    assert tab.get_lookup_table(3.0) is lookup_3pct
+    assert tab.get_lookup_table(pd.Series([1., 2.])) is lookup_curve
+    assert tab.lookup_tables.info().hits == 2
+    assert lookup_3pct.equals(tab.create_lookup_table(3))
+
+
 # ------ test cf_retirement_pension -----------------------------------
 params = ("tablename, age_insured, sex_insured, "
           "pension_age, year_cf, test_value")
@@ -174,6 +205,70 @@ def test_cf_defined_partner(tablename, age_insured, sex_insured,
             pytest.approx(test_value))
 
 
+def pv_at_3pct(payments):
+    """ Returns present value at 3% of payments (array [..., year]) at the start of the years.
+    """
+    return payments @ 1.03 ** -np.arange(payments.shape[-1])
+
+
+# the expected values are present values of the per-row cash flows of the first
+# release (tab.cf), except the ones marked *: NPLL-B after pension age, for which
+# the first release gave NaN
+@pytest.mark.parametrize("tablename, insurance_id, expected", [
+    ("AEG2011", 'NPLL-B', [1.137861039, 1.420790544, 2.257372632, 1.495031218,
+                           3.484463706, 1.357290951]),  # *
+    ("AG2014", 'NPLL-B', [1.129521186, 1.117625637, 2.51902997, 1.489289303,
+                          4.606682926, 1.462853551]),  # *
+    ("AEG2011", 'OPLL', [3.088061145, 7.577314025, 6.059271164, 15.27381044,
+                         15.13890061, 14.88512831]),
+    ("AG2014", 'OPLL', [3.411014187, 7.982249137, 6.030989848, 14.72797986,
+                        13.55081965, 14.21623669]),
+    ("AEG2011", 'NPTL-B', [0.001863090087, 0.01211774212, 0.01196679734, 0.09324638127,
+                           0.1489004997, 0.1121832143]),
+    ("AG2014", 'NPTL-O', [0, 0.01304233484, 0.01908703625, 0.06710201159,
+                          0.1876825205, 0.07737653497]),
+    ])
+def test_cf_array_mixed_sexes(tablename, insurance_id, expected):
+    tab = my_lifetable(tablename)
+    ages = np.array([15, 40, 40, 66, 67, 69])
+    sexes = np.array([MALE, FEMALE, MALE, FEMALE, MALE, FEMALE])
+    pension_ages = np.array([67, 65, 68, 67, 67, 65])
+    calculated = tab.cf_array(insurance_id, ages, sexes, pension_ages,
+                              tab.lx_array.shape[-1])
+    assert pv_at_3pct(calculated) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("tablename, insurance_id, expected", [
+    ("AEG2011", 'NPLL-O', [1.066403729, 1.182632298, 2.163736573, 1.159011146,
+                           3.205706609, 1.179552555]),
+    ("AEG2011", 'NPLLRU', [1.096134737, 1.706283624, 2.222679086, 2.352317255,
+                           3.355273801, 2.390960332]),
+    ("AG2014", 'NPLLRS', [1.272302276, 1.156760861, 2.746266563, 1.500239396,
+                          4.606682926, 1.503604765]),
+    ])
+def test_cf_array_undefined_partner_mixed_sexes(tablename, insurance_id, expected):
+    tab = my_lifetable(tablename)
+    ages = np.array([15, 40, 40, 66, 67, 69])
+    sexes = np.array([MALE, FEMALE, MALE, FEMALE, MALE, FEMALE])
+    pension_ages = np.array([67, 65, 68, 67, 67, 65])
+    nyears = tab.lx_array.shape[-1] + 52
+    out = np.full((len(ages), nyears), np.nan)
+    calculated = tab.cf_array(insurance_id, ages, sexes, pension_ages, nyears, intrest=3,
+                              out=out)
+    assert pv_at_3pct(calculated) == pytest.approx(expected)
+    assert not np.isnan(calculated).any()
+
+
+def test_cf_undefined_partner_without_intrest_is_silent(capsys):
+    tab = my_lifetable("AEG2011")
+    tab.lookup_array(3)
+    capsys.readouterr()
+    calculated = tab.cf_undefined_partner(40, MALE, 67)['payments']
+    expected = tab.cf_undefined_partner(40, MALE, 67, intrest=3)['payments']
+    assert capsys.readouterr().out == ''
+    pd.testing.assert_series_equal(calculated, expected)
+
+
 # ------ test cf_undefined_partner ------TODO: komt deze test nog niet door!**
 
 params = ("tablename, age_insured, sex_insured, "
@@ -252,3 +347,183 @@ def test_pv(tablename, cfs, intrest, rounding, test_value):
     calculated = tab.pv(cfs, intrest, rounding=rounding)
     assert (calculated == pytest.approx(test_value))
 
+
+# ------ test cashflow_cube ------------------------------------------
+# present values at 3% of the per-row cash flows of the first release (tab.cf) for
+# pension age 67 and intrest 3, for (M, 40), (M, 69), (F, 40) and (F, 69). * NPLL-B
+# after pension age, for which the first release gave NaN: value of the closed-form kernel
+CUBE_PV = {
+    'AEG2011': {'OPLL': [6.485731373, 14.16198971, 6.695929946, 14.88512831],
+                'NPLL-B': [2.236759769, 3.476458443, 1.435050667, 1.38987964],  # *
+                'NPLL-O': [2.136665135, 3.267496526, 1.200736716, 1.145049612],
+                'NPLLRS': [2.253194023, 3.551626658, 1.340096933, 1.487077418],
+                'NPLLRU': [2.19918874, 3.419946622, 1.712818772, 2.401837994],
+                'NPTL-B': [0.01196679734, 0.1908318339, 0.01211774212, 0.1121832143],
+                'NPTL-O': [0.01053078166, 0.1755652871, 0.01042125822, 0.08638107502],
+                'ay_avg': [25.61197268, 15.95810174, 23.94408892, 12.26333931]},
+    'AG2014': {'OPLL': [6.438113472, 12.54987202, 7.108590181, 14.21623669],
+               'NPLL-B': [2.522059652, 4.646471747, 1.114556806, 1.462853551],  # *
+               'NPLL-O': [2.609507955, 4.238148292, 0.9959661903, 1.144707835],
+               'NPLLRS': [2.763561252, 4.606682926, 1.141069108, 1.486633551],
+               'NPLLRU': [2.763561252, 4.606682926, 1.141069108, 1.486633551],
+               'NPTL-B': [0.02168981392, 0.2342353138, 0.01516550562, 0.1004890065],
+               'NPTL-O': [0.01908703625, 0.2154964887, 0.01304233484, 0.07737653497],
+               'ay_avg': [25.99129451, 15.48906927, 23.5073248, 10.8238399]},
+    'AG2022': {'OPLL': [6.369152279, 12.70058438, 7.103238628, 14.36755524],
+               'NPLL-B': [2.600047953, 4.557012685, 1.158797735, 1.45876094],  # *
+               'NPLL-O': [2.620117031, 4.156817398, 1.029489855, 1.14367447],
+               'NPLLRS': [2.77029612, 4.51827978, 1.173717066, 1.485291519],
+               'NPLLRU': [2.77029612, 4.51827978, 1.173717066, 1.485291519],
+               'NPTL-B': [0.0215790527, 0.2427686536, 0.01562993588, 0.1097787565],
+               'NPTL-O': [0.01898956638, 0.2233471613, 0.01344174486, 0.08452964248],
+               'ay_avg': [25.99780134, 15.55241804, 23.51790062, 10.97859941]},
+    }
+
+
+@pytest.mark.parametrize("tablename", ["AEG2011", "AG2014", "AG2022"])
+def test_cashflow_cube(tablename):
+    tab = my_lifetable(tablename)
+    pension_age, intrest = 67, 3
+    cube, labels = tab.cashflow_cube(pension_age, intrest)
+    assert cube.shape == tuple(len(x) for x in labels.values())
+    assert list(labels['sex_insured']) == [MALE, FEMALE]
+    k = [list(labels['age_insured']).index(age) for age in (40, 69)]
+    for i, insurance_id in enumerate(labels['insurance_id']):
+        calculated = pv_at_3pct(cube[i][:, k]).ravel()
+        assert calculated == pytest.approx(CUBE_PV[tablename][insurance_id])
+
+
+# ------ test pv_batch -----------------------------------------------
+# tab.pv of the per-row cash flows of the first release (tab.cf) of males of ages 15,
+# 40, 66, 67 and 69 for both curves of test_pv_batch, * see CUBE_PV
+PV_BATCH = {
+    'OPLL': [[4.17795816, 7.769680666, 15.46277083, 15.93131533, 14.85526055],
+             [3.088061145, 6.485731373, 14.62608653, 15.13890061, 14.16198971]],
+    'NPLL-B': [[1.562907231, 2.745244838, 3.863390422, 3.864507949, 3.833090174],  # *
+               [1.137861039, 2.236759769, 3.472623404, 3.484463706, 3.476458443]],  # *
+    'NPLL-O': [[1.421733537, 2.547065742, 3.563371809, 3.555347313, 3.623876545],
+               [1.060107459, 2.124978689, 3.209053848, 3.205706609, 3.267496526]],
+    'NPLLRS': [[1.500878854, 2.694441349, 3.862664895, 3.864507949, 3.938996245],
+               [1.115518872, 2.241507576, 3.47761389, 3.484463706, 3.551626658]],
+    'NPLLRU': [[1.464198977, 2.626140162, 3.723957592, 3.721227532, 3.792954101],
+               [1.089838467, 2.187502293, 3.353149808, 3.355273801, 3.419946622]],
+    'NPTL-B': [[0.002085667105, 0.01302572834, 0.1395436466, 0.1559207689, 0.1992052325],
+               [0.00183575721, 0.01179123578, 0.1311014745, 0.1467160219, 0.1880321931]],
+    'NPTL-O': [[0, 0.01146264094, 0.1283801549, 0.1434471074, 0.1832688139],
+               [0, 0.01037628749, 0.1206133566, 0.1349787402, 0.1729896177]],
+    'ay_avg': [[33.84862306, 28.21261566, 18.29709368, 17.8259942, 16.85327121],
+               [29.87602047, 25.61197268, 17.24332653, 16.82581901, 15.95810174]],
+    }
+
+
+def test_pv_batch():
+    tab = my_lifetable("AEG2011")
+    pension_age = 67
+    cube, labels = tab.cashflow_cube(pension_age, intrest=3)
+    curves = [3 * [1.5] + 60 * [2.5], 63 * [3.]]
+    calculated = tab.pv_batch(cube, curves,
+                              insurance_id=np.array(labels['insurance_id'])[:, None, None],
+                              age=labels['age_insured'],
+                              pension_age=pension_age)
+    assert calculated.shape == (len(curves),) + cube.shape[:-1]
+    k = [list(labels['age_insured']).index(age) for age in (15, 40, 66, 67, 69)]
+    for i, insurance_id in enumerate(labels['insurance_id']):
+        assert calculated[:, i, 0, k] == pytest.approx(np.array(PV_BATCH[insurance_id]))
+    assert (tab.pv_batch(cube[0, 0, 0], 3, 'OPLL') ==
+            pytest.approx(calculated[1, 0, 0, 0]))
+
+
+def test_optional_sheets_are_read_on_first_use():
+    tab = LifeTable("AEG2011")
+    assert 'testdata' not in vars(tab)
+    assert 'legend' not in vars(tab)
+    assert len(tab.testdata) > 0
+    assert 'testdata' in vars(tab)
+    assert tab.testdata is tab.testdata
+
+
+def test_generation_table_for_one_gender(ag_table):
+    tab = LifeTable("AG2014", genders=[MALE])
+    assert tab.npx(40, MALE, 25) == pytest.approx(ag_table.npx(40, MALE, 25))
+    assert np.isnan(tab.lx_array[1]).all()
+    with pytest.raises(ValueError):
+        LifeTable("AG2014", genders=['X'])
+    # partner pensions need the lx of the (opposite) gender of the beneficiary
+    cf = tab.cf('OPLL', 40, MALE, 67)
+    assert tab.pv(cf, 3) == pytest.approx(ag_table.pv(ag_table.cf('OPLL', 40, MALE, 67), 3))
+    for insurance_id in ['NPLL-B', 'NPLL-O', 'NPTL-B', 'ay_avg']:
+        with pytest.raises(ValueError):
+            tab.cf(insurance_id, 40, MALE, 67, intrest=3)
+    with pytest.raises(ValueError):
+        tab.cf_array('NPLL-B', np.array([40, 50]), MALE, 67, 100)
+
+
+def test_get_shares_tables_not_state():
+    LifeTable.clear_registry()
+    tab1 = LifeTable.get("AEG2011")
+    tab2 = LifeTable.get("AEG2011")
+    assert tab1 is not tab2
+    assert tab1.lx_array is tab2.lx_array
+    assert tab1.lookup_tables is tab2.lookup_tables
+    assert not tab1.lx_array.flags.writeable
+    tab1.calculate_factors(pension_age=67, intrest=3)
+    assert tab2.factors is None
+    assert LifeTable.get("AEG2011", calc_year=2018).lx_array is not tab1.lx_array
+
+
+def test_at_year(ag_table, aegon_table):
+    tab = ag_table.at_year(2020)
+    expected = LifeTable("AG2014", calc_year=2020)
+    assert tab.calc_year == 2020 and ag_table.calc_year == 2017
+    np.testing.assert_array_equal(tab.lx_array, expected.lx_array)
+    assert tab.npx(40, MALE, 25) == pytest.approx(expected.npx(40, MALE, 25))
+    assert tab.npx(40, MALE, 25) != pytest.approx(ag_table.npx(40, MALE, 25))
+    assert ag_table.at_year(2020).lx_array is tab.lx_array
+    assert tab.lookup_tables is not ag_table.lookup_tables
+    assert aegon_table.at_year(2020).lx_array is aegon_table.lx_array
+
+
+def test_negative_beneficiary_age(aegon_table):
+    # AEG2011: the partner of a man is 3 years younger, negative for ages 0-2
+    for insurance_id in ['NPLL-B', 'NPTL-B', 'NPTL-O', 'ay_avg']:
+        with pytest.raises(ValueError):
+            aegon_table.cf(insurance_id, 2, MALE, 67, intrest=3)
+        assert np.isfinite(aegon_table.pv(aegon_table.cf(insurance_id, 3, MALE, 67, intrest=3), 3))
+    with pytest.raises(ValueError):
+        aegon_table.cf_array('NPLL-B', np.array([2, 40]), MALE, 67, 121)
+
+
+def test_concurrent_valuation(aegon_table):
+    from concurrent.futures import ThreadPoolExecutor
+    tab = aegon_table.view()
+    calls = [(insurance_id, age, sex, intrest)
+             for insurance_id in ['OPLL', 'NPLL-B', 'NPLL-O', 'NPTL-O']
+             for age, sex in [(30, MALE), (55, FEMALE)]
+             for intrest in [1, 2.5, 4]]
+
+    def value(call):
+        insurance_id, age, sex, intrest = call
+        cf = tab.cf(insurance_id, age, sex, 67, intrest=intrest)
+        return tab.pv(cf, intrest=intrest)
+
+    expected = [value(call) for call in calls]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        calculated = list(pool.map(value, calls * 4))
+    assert calculated == pytest.approx(expected * 4)
+    assert tab.intrest is None and tab.yield_curve is None
+
+
+def test_get_factors_is_stateless(aegon_table):
+    tab = aegon_table.view()
+    factors = tab.get_factors(intrest=3, pension_age=67)
+    assert tab.factors is None and tab.cfs is None
+    pd.testing.assert_frame_equal(factors, tab.calculate_factors(intrest=3, pension_age=67))
+
+
+def test_calculate_factors_reprices_undefined_partner_only(aegon_table):
+    tab = aegon_table.view()
+    tab.calculate_factors(intrest=3, pension_age=67)
+    opll = tab.cfs.loc[tab.cfs['insurance_id'] == 'OPLL', 'cf'].iloc[0]
+    factors = tab.calculate_factors(intrest=2, pension_age=67)
+    assert tab.cfs.loc[tab.cfs['insurance_id'] == 'OPLL', 'cf'].iloc[0] is opll
+    pd.testing.assert_frame_equal(factors, tab.get_factors(intrest=2, pension_age=67))
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from factors import LifeTable
+from factors.portfolio import value_records, value_portfolio, value_file
+
+
+@pytest.fixture(scope="module")
+def portfolio(aegon_table):
+    columns = ['insurance_id', 'age', 'sex', 'pension_age', 'intrest']
+    return aegon_table.testdata[columns].iloc[::10].reset_index(drop=True)
+
+
+def test_value_records(aegon_table, portfolio):
+    calculated = value_records(aegon_table, portfolio)
+    for row in portfolio.itertuples():
+        cf = aegon_table.cf(row.insurance_id, row.age, row.sex, row.pension_age,
+                            intrest=row.intrest)
+        assert calculated[row.Index] == pytest.approx(aegon_table.pv(cf, row.intrest))
+
+
+def test_value_portfolio_keeps_input_order(aegon_table, portfolio):
+    shuffled = portfolio.sample(frac=1, random_state=0)
+    expected = value_records(aegon_table, shuffled)
+    calculated = value_portfolio(aegon_table, shuffled, workers=2, chunksize=50)
+    assert calculated.index.equals(shuffled.index)
+    pd.testing.assert_series_equal(calculated, expected)
+
+
+def test_value_records_requires_columns(aegon_table, portfolio):
+    with pytest.raises(ValueError):
+        value_records(aegon_table, portfolio.drop('intrest', axis=1))
+
+
+@pytest.mark.parametrize("extension, workers", [
+    ("csv", 1),
+    ("csv", 2),
+    ("parquet", 1),
+    ])
+def test_value_file(aegon_table, portfolio, extension, workers):
+    if extension == "parquet":
+        pytest.importorskip("pyarrow")
+    source, destination = "portfolio." + extension, "factors." + extension
+    if extension == "csv":
+        portfolio.to_csv(source, index=False)
+    else:
+        portfolio.to_parquet(source, index=False)
+    nrecords = value_file(aegon_table, source, destination, chunksize=70, workers=workers)
+    assert nrecords == len(portfolio)
+    result = (pd.read_csv(destination) if extension == "csv"
+              else pd.read_parquet(destination))
+    pd.testing.assert_frame_equal(result[portfolio.columns], portfolio, check_dtype=False)
+    expected = value_records(aegon_table, portfolio)
+    assert result['factor'].values == pytest.approx(expected.values)
+
+
+def test_value_portfolio_with_arrays_in_memory(aegon_table, portfolio):
+    tab = LifeTable.from_arrays("AEG2011", aegon_table.params, aegon_table.adjust,
+                                np.array(aegon_table.lx_array), np.array(aegon_table.hx_array))
+    expected = value_records(aegon_table, portfolio)
+    pd.testing.assert_series_equal(value_portfolio(tab, portfolio, workers=2), expected)
@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from factors.scenarios import scenario_factors
+from factors.utils import array_to_frame
+
+
+@pytest.mark.parametrize("table", ['aegon_table', 'ag_table'])
+def test_scenario_factors(table, request):
+    tab = request.getfixturevalue(table)
+    rng = np.random.default_rng(1)
+    curves = pd.DataFrame(2 + np.cumsum(rng.normal(0, .1, (5, 40)), axis=1),
+                          index=['s{}'.format(i) for i in range(5)])
+    calculated, labels = scenario_factors(tab, curves, pension_age=67, chunksize=2)
+    assert calculated.shape == (5, 7, 2, 55)
+    assert list(labels['scenario']) == list(curves.index)
+    for i in [0, 4]:
+        curve = list(curves.iloc[i])
+        cube, cube_labels = tab.cashflow_cube(67, curve)
+        expected = tab.cube_factors(cube, cube_labels, curve, 67)
+        assert calculated[i] == pytest.approx(expected, rel=1e-12)
+
+
+def test_scenario_factors_single_curve(aegon_table):
+    calculated, labels = scenario_factors(aegon_table, 3, pension_age=67)
+    calculated = array_to_frame(calculated, labels, 'factor')['factor']
+    expected = aegon_table.get_factors(intrest=3, pension_age=67)['tar'].dropna()
+    for (insurance_id, sex, age), value in expected.items():
+        assert calculated[(0, insurance_id, sex, age)] == pytest.approx(value)
+
+
+def test_calculate_factors_with_yield_curve(aegon_table):
+    tab = aegon_table.view()
+    curve = [2, 2.5, 3]
+    tab.calculate_factors(intrest=curve, pension_age=67)
+    assert tab.has_cashflows(list(curve), 67)
+    assert not tab.has_cashflows([2, 2.5, 3.5], 67)
@@ -0,0 +1,101 @@
+import asyncio
+import json
+
+import pytest
+
+from factors.service import Batcher, FactorService, check_record
+
+RECORD = {'insurance_id': 'NPLL-O', 'age': 40, 'sex': 'F', 'pension_age': 67, 'intrest': 3}
+
+
+@pytest.fixture(scope="module")
+def service():
+    return FactorService(["AEG2011"], max_latency=0.05)
+
+
+async def post(port, payload):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    body = json.dumps(payload).encode('utf-8')
+    writer.write("POST /value HTTP/1.1\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(
+        len(body)).encode('latin-1') + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, content = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), json.loads(content.decode('utf-8'))
+
+
+def test_concurrent_requests_are_batched(service, aegon_table):
+    records = [dict(RECORD, age=age) for age in range(20, 60)]
+
+    async def run():
+        return await asyncio.gather(*[service.value([record]) for record in records])
+
+    batcher = service.batchers["AEG2011"]
+    nbatches = batcher.nbatches
+    calculated = [values[0] for values in asyncio.run(run())]
+    assert batcher.nbatches == nbatches + 1
+    expected = [aegon_table.pv(aegon_table.cf('NPLL-O', age, 'F', 67, intrest=3), intrest=3)
+                for age in range(20, 60)]
+    assert calculated == pytest.approx(expected)
+
+
+def test_check_record_ages(aegon_table):
+    assert check_record(dict(RECORD, insurance_id='NPTL-O', age=69), aegon_table)
+    for record in [dict(RECORD, insurance_id='NPTL-O', age=120),
+                   dict(RECORD, insurance_id='NPTL-O', age=70),
+                   dict(RECORD, insurance_id='NPLL-B', age=119, sex='M'),
+                   dict(RECORD, pension_age=71)]:
+        with pytest.raises(ValueError):
+            check_record(record, aegon_table)
+
+
+def test_check_record_minimum_age(service, aegon_table):
+    # the beneficiary of a male insured is delta = 3 years younger
+    assert check_record(dict(RECORD, insurance_id='NPLL-B', age=3, sex='M'), aegon_table)
+    assert check_record(dict(RECORD, insurance_id='NPLL-B', age=2, sex='F'), aegon_table)
+    record = dict(RECORD, insurance_id='NPLL-B', age=2, sex='M')
+    with pytest.raises(ValueError):
+        check_record(record, aegon_table)
+
+    async def run():
+        server = await service.start(port=0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            return await post(port, record)
+
+    status, body = asyncio.run(run())
+    assert status == 400
+    assert 'between 3 and' in body['error']
+
+
+def test_failing_request_does_not_fail_batch(aegon_table):
+    batcher = Batcher(aegon_table, max_latency=0.05)
+    valid = [dict(RECORD, age=age) for age in [30, 40]]
+    invalid = dict(RECORD, insurance_id='NPTL-O', age=120)  # not checked
+
+    async def run():
+        return await asyncio.gather(*[batcher.value([record])
+                                      for record in [valid[0], invalid, valid[1]]],
+                                    return_exceptions=True)
+
+    first, failed, second = asyncio.run(run())
+    assert isinstance(failed, IndexError)
+    expected = [aegon_table.pv(aegon_table.cf('NPLL-O', age, 'F', 67, intrest=3), intrest=3)
+                for age in [30, 40]]
+    assert [first[0], second[0]] == pytest.approx(expected)
+
+
+def test_http(service):
+    async def run():
+        server = await service.start(port=0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            return await asyncio.gather(post(port, RECORD),
+                                        post(port, [RECORD, dict(RECORD, sex='M')]),
+                                        post(port, dict(RECORD, sex='X')))
+
+    single, bulk, invalid = asyncio.run(run())
+    assert single[0] == 200 and bulk[0] == 200
+    assert bulk[1]['factors'][0] == pytest.approx(single[1]['factor'])
+    assert invalid[0] == 400
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from factors.settings import MALE, FEMALE
+from factors.utils import get_excel_filepath
+from factors.utils_extra import (read_generation_table, read_qx_array, generation_qx,
+                                 flatten_generation_table,
+                                 diagonals_to_columns, qx_to_npx, stack_columns)
+
+
+def flatten_generation_table_pandas(data):
+    """ Reference implementation of flatten_generation_table with pandas.
+    """
+    lx_tables = {}
+    for gender in [MALE, FEMALE]:
+        df = diagonals_to_columns(data[gender])
+        df = qx_to_npx(df)
+        df.fillna(1, inplace=True)
+        lx_tables[gender] = stack_columns(df)
+    return lx_tables
+
+
+@pytest.mark.parametrize("tablename, calc_year", [
+    ("AG2014", 2017),
+    ("AG2022", 2022),
+    ])
+def test_flatten_generation_table(tablename, calc_year):
+    data = read_generation_table(get_excel_filepath(tablename), tablename, calc_year)
+    calculated = flatten_generation_table(data)
+    expected = flatten_generation_table_pandas(data)
+    for gender in [MALE, FEMALE]:
+        assert calculated[gender].index.equals(expected[gender].index)
+        np.testing.assert_allclose(calculated[gender]['lx'].values,
+                                   expected[gender]['lx'].values, rtol=1e-14)
+
+
+def test_read_qx_array():
+    xlswb = get_excel_filepath("AG2014")
+    qx = read_qx_array(xlswb, "AG2014")
+    data = read_generation_table(xlswb, "AG2014", 2019)
+    for i, gender in enumerate([MALE, FEMALE]):
+        np.testing.assert_array_equal(generation_qx(qx, 2019)[i], data[gender].values)
+    with pytest.raises(ValueError):
+        generation_qx(qx, 2013)
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from factors.writers import write_sheets, output_format, write_table, read_table
+
+
+def test_write_sheets_xlsx():
+    index = pd.MultiIndex.from_product([[15, 16], [0, 1]], names=['age', 'year'])
+    columns = pd.MultiIndex.from_product([['M', 'F'], ['OPLL']], names=['sex', 'insurance_id'])
+    frame = pd.DataFrame(np.arange(8.).reshape(4, 2), index=index, columns=columns)
+    frame.iloc[0, 0] = np.nan
+    write_sheets({'cashflows': frame}, "out.xlsx")
+    result = pd.read_excel("out.xlsx", sheet_name='cashflows', header=[0, 1], index_col=[0, 1])
+    pd.testing.assert_frame_equal(result, frame, check_names=False, check_dtype=False)
+
+
+@pytest.mark.parametrize("extension", ['csv', 'parquet'])
+def test_write_sheets_flat(extension):
+    frame = pd.DataFrame({'lx': [1., .5]}, index=pd.Index([0, 1], name='age'))
+    filepaths = write_sheets({'lx': frame}, "out." + extension)
+    assert filepaths == ["out_lx." + extension]
+    result = pd.read_csv(filepaths[0]) if extension == 'csv' else pd.read_parquet(filepaths[0])
+    pd.testing.assert_frame_equal(result, frame.reset_index())
+
+
+def test_output_format():
+    assert output_format("a.XLSX") == 'xlsx'
+    with pytest.raises(ValueError):
+        output_format("a.txt")
+
+
+@pytest.mark.parametrize("extension", ['parquet', 'feather'])
+def test_cashflow_table_roundtrip(aegon_table, extension):
+    pyarrow = pytest.importorskip("pyarrow")
+    cashflows = aegon_table.cashflow_table(pension_age=67, intrest=3)
+    assert list(cashflows.columns) == ['insurance_id', 'sex', 'age', 'year', 'payment']
+    write_table(cashflows, "cashflows." + extension)
+    allocated = pyarrow.total_allocated_bytes()
+    table = read_table("cashflows." + extension)
+    if extension == 'feather':
+        assert pyarrow.total_allocated_bytes() == allocated  # memory mapped
+    pd.testing.assert_frame_equal(table.to_pandas(), cashflows)
+
+
+def test_factor_table(aegon_table):
+    factors = aegon_table.factor_table(intrest=3, pension_age=67).set_index(
+        ['insurance_id', 'sex', 'age'])['factor']
+    expected = aegon_table.get_factors(intrest=3, pension_age=67)['tar'].dropna()
+    assert factors.loc[expected.index].values == pytest.approx(expected.values)
@@ -1,11 +1,12 @@
 import glob
 import itertools
+from collections import OrderedDict
 import os
 
 import numpy as np
 import pandas as pd
 
-from factors.settings import DATADIR
+from factors.settings import DATADIR, GENDERS
 
 
 def get_excel_filepath(tablename):
@@ -18,6 +19,39 @@ def get_excel_filepath(tablename):
     return excel_filepath
 
 
+class lazy_property(object):
+    """ Decorator for a property which is computed on first access.
+
+    The value is stored on the instance (replacing the property),
+    so it is computed only once and can be overwritten.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+        self.name = func.__name__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        value = self.func(obj)
+        obj.__dict__[self.name] = value
+        return value
+
+
+def gender_index(sex):
+    """ Returns position(s) of given sex on the gender axis of the lx/hx arrays.
+
+    Parameters:
+    -----------
+    sex: either 'M' of 'F', or array-like of these
+    """
+    sex = np.asarray(sex)
+    if not ((sex == GENDERS[0]) | (sex == GENDERS[1])).all():
+        raise ValueError("sex should be either {0} or {1}".format(*GENDERS))
+    return (sex == GENDERS[1]).astype(int)
+
+
 def merge_two_dicts(x, y):
     """Given two dicts, merge them into a new dict as a shallow copy.
     http://stackoverflow.com/questions/38987/how-can-i-merge-two-python-dictionaries-in-a-single-expression
@@ -101,6 +135,53 @@ def cartesian(lists, colnames):
     return df
 
 
+def array_to_frame(array, labels, name):
+    """ Returns DataFrame with one row per element of array and a MultiIndex
+    of the labels of its axes.
+
+    Parameters:
+    -----------
+    array: array
+    labels: OrderedDict {axis name: labels}, for example of LifeTable.cashflow_cube
+    name: str, name of the value column
+    """
+    index = pd.MultiIndex.from_product(list(labels.values()), names=list(labels.keys()))
+    return pd.DataFrame({name: np.asarray(array).ravel()}, index=index)
+
+
+def array_to_table(array, labels, name):
+    """ Returns DataFrame in long (columnar) format: one column per axis of
+    array and a float64 value column, with one row per element.
+
+    Text labels become categorical columns, integer labels int16 columns.
+
+    Parameters:
+    -----------
+    array: array
+    labels: OrderedDict {column name: labels of axis}
+    name: str, name of the value column
+    """
+    array = np.asarray(array, dtype=float)
+    out = OrderedDict()
+    for axis, (column, values) in enumerate(labels.items()):
+        shape = [1] * array.ndim
+        shape[axis] = len(values)
+        codes = np.broadcast_to(np.arange(len(values)).reshape(shape), array.shape).ravel()
+        out[column] = label_column(values, codes)
+    out[name] = array.ravel()
+    return pd.DataFrame(out)
+
+
+def label_column(labels, codes):
+    """ Returns column with labels[codes] for a long table: int16 for integer labels,
+    categorical for text labels.
+    """
+    labels = np.asarray(labels)
+    if labels.dtype.kind in 'iu':
+        return labels.astype(np.int16)[codes]
+    return pd.Categorical.from_codes(codes, categories=list(labels))
+
+
 def x_to_series(x, n):
     """ Converts int, float or list to Series of length n.
 
@@ -110,7 +191,7 @@ def x_to_series(x, n):
     length: required length of returned Series
     """
 
-    if isinstance(x, (int, float)):
+    if isinstance(x, (int, float, np.number)):
         s = pd.Series(n * [x])
     elif isinstance(x, (list, pd.Series)):
         x = list(x.values) if isinstance(x, pd.Series) else x
@@ -120,3 +201,72 @@ def x_to_series(x, n):
     else:
         print("Error!")
     return s
+
+
+def x_to_matrix(x, n):
+    """ Converts int, float, list, Series or 2-D array to array of shape (nrows, n).
+
+    Rows shorter than n are padded with their last value (see x_to_series),
+    longer rows are truncated.
+
+    Parameters:
+    -----------
+    x: int, float, list, Series, 2-D array or DataFrame (one row per scenario)
+    n: required number of columns
+    """
+    x = np.array(x, dtype=float, ndmin=2)
+    if x.ndim != 2:
+        raise ValueError("x should have at most 2 dimensions")
+    if x.shape[1] < n:
+        padding = np.repeat(x[:, -1:], n - x.shape[1], axis=1)
+        x = np.concatenate([x, padding], axis=1)
+    return x[:, :n]
+
+
+def half_year(insurance_id, age, pension_age, year):
+    """ Returns boolean array which is True for payments discounted to the middle of the year.
+
+    Retirement and partner pensions are paid at the start of the year
+    (OPLL, NPLL-B, ay_avg), one year risk premiums in the middle of the year
+    (NPTL-B, NPTL-O) and undefined partner pensions in the middle of the year
+    till pension age (NPLL-O, NPLLRS, NPLLRU). All arguments are broadcast
+    against each other.
+
+    Parameters:
+    -----------
+    insurance_id: str or array of str
+    age: int or array, required for undefined partner
+    pension_age: int or array, required for undefined partner
+    year: int or array
+    """
+    insurance_id = np.asarray(insurance_id)
+    year = np.asarray(year)
+    whole_year = np.isin(insurance_id, ['OPLL', 'NPLL-B', 'ay_avg'])
+    half_year = np.isin(insurance_id, ['NPTL-B', 'NPTL-O'])
+    mixed = np.isin(insurance_id, ['NPLL-O', 'NPLLRS', 'NPLLRU'])
+    if not (whole_year | half_year | mixed).all():
+        unknown = np.unique(insurance_id[~(whole_year | half_year | mixed)])
+        raise ValueError("cannot process insurance_id: {0}".format(", ".join(unknown)))
+    out = half_year
+    if mixed.any():
+        nyears_till_pension_age = np.asarray(pension_age) - np.asarray(age)
+        out = out | (mixed & (year <= nyears_till_pension_age))
+    return np.broadcast_to(out, np.broadcast(out, year).shape)
+
+
+def half_year_mask(insurance_id, age, pension_age, nyears):
+    """ Returns boolean array (..., nyears) which is True for years discounted to the
+    middle of the year, see half_year.
+
+    Parameters:
+    -----------
+    insurance_id: str or array of str
+    age: int or array, required for undefined partner
+    pension_age: int or array, required for undefined partner
+    nyears: int
+    """
+    def expand(x):
+        return None if x is None else np.asarray(x)[..., None]
+
+    return half_year(expand(insurance_id), expand(age), expand(pension_age),
+                     np.arange(nyears))
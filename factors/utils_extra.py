@@ -2,7 +2,9 @@ import os
 
 import pandas as pd
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 from factors import settings
+from factors.cache import read_sheet
 
 # AG2014 characteristics
 from factors.settings import DATADIR
@@ -15,8 +17,7 @@ def read_generation_table(xlswb, sheet_name, calc_year):
     """ Return generations tables (M, F), starting from calculation year
     """
     tables = {}
-    data = pd.read_excel(xlswb, skiprows=0, sheet_name=sheet_name)
-    # TODO: sheet(_)name: Python 2 vs 3
+    data = read_sheet(xlswb, sheet_name)
     for gender in [settings.MALE, settings.FEMALE]:
         tab = data[data['gender'] == gender]
         tab = tab.iloc[:, 1:]
@@ -30,6 +31,31 @@ def read_generation_table(xlswb, sheet_name, calc_year):
     return tables
 
 
+def read_qx_array(xlswb, sheet_name):
+    """ Return qx array [gender, age, year] of all years of the generation table.
+
+    Unlike read_generation_table, no years are skipped: use generation_qx
+    to select the years from a calculation year.
+    """
+    data = read_sheet(xlswb, sheet_name)
+    out = []
+    for gender in [settings.MALE, settings.FEMALE]:
+        tab = data[data['gender'] == gender]
+        out.append(tab.iloc[:, 2:].to_numpy(dtype=float))
+    return np.stack(out)
+
+
+def generation_qx(qx, calc_year):
+    """ Return qx array [..., age, year] of read_qx_array starting from calculation year.
+    """
+    years_to_skip = calc_year - STARTYEAR
+    if years_to_skip < 0:
+        raise ValueError("calculation year should be >= {}".format(STARTYEAR))
+    return qx[..., years_to_skip:]
+
+
+# Deprecated: the pandas implementation of flatten_generation_table, replaced by
+# generation_lx_array. Kept for backwards compatibility and as reference in the tests.
 def diagonals_to_columns(df):
     """ Return df with lower triangle diagonals converted to columns.
     """
@@ -62,15 +88,44 @@ def stack_columns(df):
     return pd.DataFrame(out, columns=['lx'])
 
 
+def generation_lx_array(qx):
+    """ Return lx array [current_age, age] for 2 dimensional qx array [age, year].
+
+    A person with current age c is aged c + k in year k, so its qx are found
+    on the diagonals of the qx table. lx[c, x] = 1 for x <= c and NaN
+    for years not covered by the qx table.
+    """
+    qx = np.asarray(qx, dtype=float)
+    nages = qx.shape[0]
+    padded = np.full((2 * nages, max(qx.shape[1], nages)), np.nan)
+    padded[:nages, :qx.shape[1]] = qx
+    row_stride, col_stride = padded.strides
+    # cohort_qx[c, k] = qx[c + k, k]
+    cohort_qx = as_strided(padded, shape=(nages, nages),
+                           strides=(row_stride, row_stride + col_stride))
+    npx = np.ones((nages, 2 * nages))
+    np.cumprod(1 - cohort_qx[:, :-1], axis=1, out=npx[:, nages + 1:])
+    row_stride, col_stride = npx.strides
+    # lx[c, x] = npx[c, nages + x - c]
+    lx = as_strided(npx[:, nages:], shape=(nages, nages),
+                    strides=(row_stride - col_stride, col_stride))
+    return lx.copy()
+
+
+def lx_array_to_frame(lx):
+    """ Convert lx array [current_age, age] to DataFrame with index (current, age)
+    """
+    index = pd.MultiIndex.from_product([range(lx.shape[0]), range(lx.shape[1])],
+                                       names=['current', 'age'])
+    return pd.DataFrame({'lx': lx.ravel()}, index=index)
+
+
 def flatten_generation_table(data):
     """ Convert 2 dimensional qx table to 1 dimensional lx
     """
     lx_tables = {}
     for gender in [settings.MALE, settings.FEMALE]:
-        df = diagonals_to_columns(data[gender])
-        df = qx_to_npx(df)
-        df.fillna(1, inplace=True)
-        lx_tables[gender] = stack_columns(df)
+        lx_tables[gender] = lx_array_to_frame(generation_lx_array(data[gender].values))
     return lx_tables
 
 
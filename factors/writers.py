@@ -0,0 +1,157 @@
+""" Writers for exporting a number of DataFrames (sheets) at once.
+
+Excel workbooks are written with openpyxl in write-only mode, which streams
+rows to disk instead of building the whole workbook in memory. For large
+runs the sheets can also be written as csv, parquet or Arrow IPC (feather)
+files, one file per sheet.
+"""
+import os
+
+import numpy as np
+
+OUTPUT_FORMATS = ('xlsx', 'csv', 'parquet', 'feather', 'arrow')
+ARROW_FORMATS = ('parquet', 'feather', 'arrow')
+
+
+def output_format(filepath):
+    """ Returns output format (see OUTPUT_FORMATS) of given filepath.
+    """
+    extension = os.path.splitext(filepath)[1].lower()[1:]
+    if extension not in OUTPUT_FORMATS:
+        raise ValueError("Unsupported file type {0}, use one of {1}".format(
+            filepath, ", ".join(OUTPUT_FORMATS)))
+    return extension
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Reading and writing parquet/arrow files requires pyarrow")
+    return pyarrow
+
+
+def _cell(value):
+    """ Returns value openpyxl can write: None for missing values, Python scalars.
+    """
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+
+def frame_rows(frame):
+    """ Yields rows (lists) of frame as laid out by DataFrame.to_excel:
+    one header row per column level, followed by index and values.
+    """
+    nlevels = frame.index.nlevels
+    index_names = [name if name is not None else '' for name in frame.index.names]
+    columns = frame.columns
+    if columns.nlevels == 1:
+        yield index_names + [_cell(x) for x in columns]
+    else:
+        for level in range(columns.nlevels):
+            name = columns.names[level]
+            label = [name if name is not None else ''] if nlevels else []
+            yield (label + [''] * (nlevels - 1) +
+                   [_cell(x) for x in columns.get_level_values(level)])
+        yield index_names + [''] * len(columns)
+    index = (frame.index.tolist() if nlevels > 1 else
+             [(x,) for x in frame.index.tolist()])
+    values = frame.to_numpy(dtype=object)
+    for labels, row in zip(index, values):
+        yield [_cell(x) for x in labels] + [_cell(x) for x in row]
+
+
+def write_xlsx(sheets, xlswb):
+    """ Writes sheets {sheet_name: DataFrame} to xlswb with a write-only workbook.
+    """
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    for sheet_name, frame in sheets.items():
+        ws = wb.create_sheet(sheet_name)
+        for row in frame_rows(frame):
+            ws.append(row)
+    wb.save(xlswb)
+
+
+def flatten_columns(frame):
+    """ Returns frame with (named) index reset and multi level column names joined with '_'.
+    """
+    if any(name is not None for name in frame.index.names):
+        frame = frame.reset_index()
+    else:
+        frame = frame.copy(deep=False)
+    if frame.columns.nlevels > 1:
+        frame.columns = ['_'.join(str(x) for x in column if x != '')
+                         for column in frame.columns]
+    else:
+        frame.columns = [str(x) for x in frame.columns]
+    return frame
+
+
+def get_sheet_filepath(filepath, sheet_name):
+    """ Returns file path for given sheet: <root>_<sheet_name>.<extension>.
+    """
+    root, extension = os.path.splitext(filepath)
+    return "{0}_{1}{2}".format(root, sheet_name, extension)
+
+
+def write_table(frame, filepath):
+    """ Writes frame (without its index) to a parquet, feather or arrow file.
+
+    Feather and arrow files are written uncompressed, so read_table can
+    memory map them without copying.
+    """
+    fmt = output_format(filepath)
+    if fmt not in ARROW_FORMATS:
+        raise ValueError("write_table requires one of {}".format(", ".join(ARROW_FORMATS)))
+    pyarrow = import_pyarrow()
+    table = pyarrow.Table.from_pandas(frame, preserve_index=False)
+    if fmt == 'parquet':
+        pyarrow.parquet.write_table(table, filepath)
+    else:
+        pyarrow.feather.write_feather(table, filepath, compression='uncompressed')
+
+
+def read_table(filepath):
+    """ Returns pyarrow Table of a parquet, feather or arrow file.
+
+    Feather and arrow files are memory mapped: the columns refer to the
+    file instead of being copied into memory.
+    """
+    pyarrow = import_pyarrow()
+    if output_format(filepath) == 'parquet':
+        return pyarrow.parquet.read_table(filepath, memory_map=True)
+    return pyarrow.feather.read_table(filepath, memory_map=True)
+
+
+def write_sheets(sheets, filepath):
+    """ Writes sheets {sheet_name: DataFrame} to filepath.
+
+    For xlsx all sheets are written to one workbook. For the other formats
+    every sheet is written to its own file, see get_sheet_filepath, with the
+    (named) index as regular columns. Returns list of written files.
+
+    Parameters:
+    -----------
+    sheets: dict
+    filepath: str, with extension xlsx, csv, parquet, feather or arrow
+    """
+    fmt = output_format(filepath)
+    if fmt == 'xlsx':
+        write_xlsx(sheets, filepath)
+        return [filepath]
+    out = []
+    for sheet_name, frame in sheets.items():
+        sheet_filepath = get_sheet_filepath(filepath, sheet_name)
+        frame = flatten_columns(frame)
+        if fmt == 'csv':
+            frame.to_csv(sheet_filepath, index=False)
+        else:
+            write_table(frame, sheet_filepath)
+        out.append(sheet_filepath)
+    return out